@@ -0,0 +1,223 @@
+'''
+Benchmark of the stages of the program on a synthetic Sentinel-2 scene generated on the fly,
+so it needs no downloaded data:
+
+>>> python benchmark.py --size 2048 --repeat 3 --output benchmarks.jsonl
+
+Each stage is timed separately through the entry points of the program (read(), the Bands it
+returns, indices.*, simple.* and the writers) and its throughput in megapixels per second and
+the peak memory of the arrays allocated inside it are reported, see stages(). With --workers
+1 2 4, the windowed GeoTIFFs of several indices are also streamed with each number of
+processes, to measure the speedup of the pool. Every run appends one JSON line per stage to the
+output file, tagged with the current git commit, so results can be compared across commits.
+'''
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from functools import partial
+import numpy as np
+import rasterio as rs
+from rasterio.transform import from_origin
+import matplotlib
+matplotlib.use("Agg")
+from functions import bands
+from functions import indices
+from functions import simple
+from functions import render
+from functions import writers
+from functions import tiling
+from functions import metrics
+from main import read
+
+def synthetic(path: str, size: int, seed=0):
+    '''
+    Description
+    -----------
+    Writes a synthetic scene with one tiled, compressed uint16 GeoTIFF per band, each one at
+    its native resolution, named as read() expects.
+
+    Parameters
+    -----------
+    path: str
+        Folder where the images are written.
+    size: int
+        Side in pixels of the 10 m bands. It should be a multiple of 6.
+    seed: int, optional
+        Seed of the random generator, so every run uses the same scene. Default is 0.
+
+    Returns
+    -------
+    path: str
+        The same folder.
+    '''
+    rng = np.random.default_rng(seed)
+    for code, resolution in bands.RESOLUTIONS.items():
+        side = size * 10 // resolution
+        # Campo suave con ruido, parecido a una reflectancia de 12 bits
+        y, x = np.mgrid[0:side, 0:side] / side
+        data = 2000 + 1500 * np.sin(6 * x + rng.random()) * np.cos(4 * y) + rng.normal(0, 200, (side, side))
+        profile = {"driver": "GTiff", "height": side, "width": side, "count": 1, "dtype": "uint16",
+                   "crs": "EPSG:32614", "transform": from_origin(500000, 2000000, resolution, resolution),
+                   "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate"}
+        with rs.open(os.path.join(path, f"T00XXX_20200101T000000_{code}.tif"), "w", **profile) as dst:
+            dst.write(np.clip(data, 1, 4095).astype("uint16"), 1)
+    return path
+
+def commit():
+    '''
+    Returns the hash of the current git commit, or None outside a repository.
+    '''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def stages(path: str, output: str, workers=()):
+    '''
+    Description
+    -----------
+    Runs every stage once over a scene and measures it. The stages go through the same entry
+    points as the program, so a regression in any of them shows up here:
+
+    - open: read(), which finds the bands and the grid without decoding them. It handles
+      metadata only, so it has no throughput.
+    - decode, resample, normalize: the stages of load() and load_group() while every band is
+      read by Bands.prefetch() with a single thread, so each one is timed on its own: the
+      bands already on the grid, the rest in groups with the same native grid and method, and
+      the normalization of all of them.
+    - prefetch: Bands.prefetch() of every band on a new read(), with the default threads, so
+      the reads overlap as in the program.
+    - lazy: every band accessed one by one on a new read(), through Bands.__getitem__() and
+      load().
+    - index: indices.batch() of every index on the Bands object.
+    - compute: indices.compute() of every index, one at a time.
+    - composite[name]: each composition of simple.py.
+    - render, write, stream[n]: the quicklooks, the GeoTIFF and the windowed GeoTIFFs.
+
+    The peak memory of each stage is traced with a metrics.Recorder, so it is the most memory
+    the arrays allocated inside the stage held at once. The processes of stream[n] are not
+    traced, only what the stage allocates in this process.
+
+    Parameters
+    -----------
+    path: str
+        Folder of the scene.
+    output: str
+        Folder where the rendered and written files go.
+    workers: iterable, optional
+        Numbers of processes the windowed GeoTIFF of several indices is streamed with, each
+        timed as a stage "stream[n]", to measure the speedup of tiling.stream_many(). Default
+        is (), which skips it.
+
+    Returns
+    -------
+    results: list
+        (stage, seconds, megapixels, peak memory in MB) of every stage. The megapixels are
+        None for the stages without a throughput.
+    '''
+    results = list()
+
+    def megabytes(recorder, stage):
+        return round(recorder.stages[stage]["peak_bytes"] / 1024**2, 1)
+
+    def measure(stage, function):
+        recorder = metrics.enable(memory=True)
+        try:
+            # Con un nombre propio, para no sumarse a las etapas de la biblioteca como index o write
+            with metrics.stage(f"bench:{stage}"):
+                value = function()
+        finally:
+            metrics.disable()
+        return value, recorder
+
+    def run(stage, megapixels, function):
+        value, recorder = measure(stage, function)
+        record = f"bench:{stage}"
+        results.append((stage, recorder.stages[record]["seconds"], megapixels, megabytes(recorder, record)))
+        return value
+
+    def open_scene(threads=bands.THREADS):
+        # Sin los mensajes de read(); las bandas se miden aquí y no se imprimen
+        with redirect_stdout(io.StringIO()):
+            images = read(1, 12, path, resolution=None, threads=threads)
+        images.verbose = False
+        return images
+
+    files = bands.find(path)
+    full = bands.shape_of(files[bands.REFERENCE])
+    full = full[0] * full[1] / 1e6
+    images = run("open", None, partial(open_scene, threads=1))
+    on_grid = [code for code in images.files if images.native_shape(code) == images.shape]
+    upsampled = [code for code in images.files if code not in on_grid]
+    _, recorder = measure("read", lambda: images.prefetch(images.files))
+    for stage, name, count in (("decode", "decode", len(on_grid)), ("resample", "decode+resample", len(upsampled)),
+                               ("normalize", "normalize", len(images.files))):
+        if name in recorder.stages:
+            results.append((stage, recorder.stages[name]["seconds"], count * full, megabytes(recorder, name)))
+    fresh = open_scene()
+    run("prefetch", len(fresh.files) * full, lambda: fresh.prefetch(fresh.files))
+    lazy = open_scene()
+    run("lazy", len(lazy.files) * full, lambda: [lazy[code] for code in lazy.files])
+    names = list(indices.INDICES)
+    results_indices = run("index", len(names) * full, lambda: indices.batch(images, names))
+    run("compute", len(names) * full, lambda: [indices.compute(images, name) for name in names])
+    composites = dict()
+    for name in ("natural_color", "infrared", "shortwave_ir", "agriculture", "geology", "bathymetric"):
+        composites[name] = run(f"composite[{name}]", 3 * full, partial(getattr(simple, name), images))
+    ndvi = results_indices["ndvi"]
+    run("render", 2 * full, lambda: (render.save(render.colorize(ndvi), os.path.join(output, "ndvi.png")),
+                                     render.save(render.composite(composites["natural_color"]),
+                                                 os.path.join(output, "natural.png"))))
+    crs, transform = writers.georeference(images, ["B08"])
+    run("write", full, lambda: writers.write(ndvi, os.path.join(output, "ndvi.tif"), crs, transform))
+    streamed = ["ndvi", "ndwi", "bsi", "evi"]
+    for count in workers:
+        outputs = {name: os.path.join(output, f"{name}-{count}.tif") for name in streamed}
+        run(f"stream[{count}]", len(streamed) * full,
+            lambda: tiling.stream_many(images, outputs, size=512, workers=count))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the program on a synthetic scene.")
+    parser.add_argument("--size", type=int, default=1098 * 2, help="side in pixels of the 10 m bands")
+    parser.add_argument("--repeat", type=int, default=3, help="runs; the fastest time of each stage is kept")
+    parser.add_argument("--output", default="benchmarks.jsonl", help="JSON lines file the results are appended to")
+    parser.add_argument("--workers", type=int, nargs="*", default=[],
+                        help="numbers of processes to stream GeoTIFFs with, e.g. --workers 1 2 4")
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp(prefix="sentinel-2-benchmark-")
+    try:
+        scene = os.path.join(folder, "scene")
+        os.makedirs(scene)
+        synthetic(scene, args.size)
+        runs = [stages(scene, folder, args.workers) for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    header = {"commit": commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "size": args.size,
+              "python": platform.python_version(), "numpy": np.__version__, "gdal": rs.__gdal_version__}
+    print(f"{'stage':<24}{'seconds':>10}{'MP/s':>10}{'peak MB':>10}")
+    with open(args.output, "a") as file:
+        for i, (stage, _, megapixels, _) in enumerate(runs[0]):
+            seconds = min(run[i][1] for run in runs)
+            memory = max(run[i][3] for run in runs)
+            throughput = None if megapixels is None else round(megapixels / seconds, 2)
+            record = dict(header, stage=stage, seconds=round(seconds, 5),
+                          megapixels=None if megapixels is None else round(megapixels, 3),
+                          mpx_per_s=throughput, peak_mb=memory)
+            file.write(json.dumps(record) + "\n")
+            print(f"{stage:<24}{seconds:>10.4f}{'-' if throughput is None else f'{throughput:.1f}':>10}{memory:>10}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+'''
+Non-interactive entry point of the program. It never asks for input nor opens a window, so it
+can be run from cron jobs and containers without a display:
+
+>>> python cli.py /data/T14QLG_20230101 /data/T14QLG_20230106 --composite natural \
+        --index ndvi --index ndmi --format tif --workers 8 --output /data/products
+
+Many scenes can be given as glob patterns or in a manifest, processed several at a time and
+resumed after a crash, skipping the products already written:
+
+>>> python cli.py "/data/T14QLG_2023*" --manifest scenes.txt --index ndvi --format tif \
+        --jobs 4 --state products.sqlite
+'''
+import os
+import sys
+import argparse
+from functools import partial
+import numpy as np
+import matplotlib
+# Sin pantalla: matplotlib solo se usa para guardar las imágenes
+matplotlib.use("Agg")
+from functions import simple
+from functions import indices
+from functions import tiling
+from functions import cache
+from functions import writers
+from functions import metrics
+from functions import normalize
+from functions import scheduler
+from functions import bands
+from functions import safe
+from main import read
+
+COMPOSITES = {
+    "natural": (simple.natural_color, "Natural color"),
+    "infrared": (simple.infrared, "False infrared"),
+    "swir": (simple.shortwave_ir, "Short wave infrared"),
+    "agriculture": (simple.agriculture, "Agriculture"),
+    "geology": (simple.geology, "Geology"),
+    "bathymetric": (simple.bathymetric, "Bathymetric"),
+}
+
+def parse(argv=None):
+    '''
+    Parses the arguments of the command line.
+    '''
+    parser = argparse.ArgumentParser(description="Create compositions and indices of Sentinel-2 scenes "
+                                                 "without any prompt.")
+    parser.add_argument("scenes", nargs="*", help="folders that contain the .tif images of each scene, Sentinel-2 "
+                                                  ".SAFE directories or .zip products, or glob patterns of them")
+    parser.add_argument("--manifest", help="text file with one scene folder or glob pattern per line; lines "
+                                           "starting with # are skipped")
+    parser.add_argument("-c", "--composite", action="append", default=[], choices=sorted(COMPOSITES),
+                        help="composition to create, can be repeated")
+    parser.add_argument("-i", "--index", action="append", default=[], choices=sorted(indices.INDICES),
+                        help="index to compute, can be repeated; all of them are computed in one pass")
+    parser.add_argument("-f", "--format", default="png", choices=("png", "tif"),
+                        help="output format of the indices: a PNG with colorbar, or a Cloud-Optimized "
+                             "GeoTIFF computed window by window (compositions are always PNG)")
+    parser.add_argument("--encoding", default="float32", choices=sorted(writers.ENCODINGS),
+                        help="data type of the GeoTIFFs; int16 stores the values scaled by 10000")
+    parser.add_argument("--compress", default="deflate", choices=("deflate", "zstd"),
+                        help="compression of the GeoTIFFs")
+    parser.add_argument("-o", "--output", help="folder where the Compositions folder is created; "
+                                                "default is the folder of each scene")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="processes used to compute the GeoTIFFs")
+    parser.add_argument("-t", "--threads", type=int, default=bands.THREADS,
+                        help="bands of a composition or index read at the same time")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="scenes processed at the same time, each in "
+                                                                  "its own process")
+    parser.add_argument("--state", help="SQLite file where the products done are recorded; products found done "
+                                        "in it, whose files still exist, are not computed again")
+    parser.add_argument("--window", type=int, default=tiling.WINDOW, help="side in pixels of the windows")
+    parser.add_argument("--cmap", default="viridis", help="matplotlib colormap of the indices")
+    parser.add_argument("--dtype", default="float32", help="data type of the computation")
+    parser.add_argument("--resolution", default="finest",
+                        help='grid of each product: "finest", "coarsest" or a band code such as B02')
+    parser.add_argument("--preview", type=int, help="largest side in pixels of the products, for quicklooks")
+    parser.add_argument("--stretch", default="max", choices=normalize.STRETCHES,
+                        help="normalization of the bands and indices: by their maximum, or by their "
+                             "99th percentile clipping the values above it")
+    parser.add_argument("--mask", help='pixels to leave out: "scl" for the clouds, shadows and nodata of the '
+                                             'SCL file of each scene, or the path of a raster whose nonzero '
+                                             'pixels are masked')
+    parser.add_argument("--cache", nargs="?", const=cache.DIRECTORY, metavar="DIR",
+                        help="keep the resampled bands in an on-disk cache, in the given folder or in "
+                             f"{cache.DIRECTORY}, so later runs on the same scenes reuse them; off by default")
+    parser.add_argument("--metrics", help="file where the time, bytes and peak memory of each stage of each "
+                                          "scene are written: Prometheus text if it ends with .prom, "
+                                          "otherwise JSON lines appended to it")
+    args = parser.parse_args(argv)
+    if not args.composite and not args.index:
+        parser.error("at least one --composite or --index is required")
+    for option in ("jobs", "workers", "threads"):
+        if getattr(args, option) < 1:
+            parser.error(f"--{option} must be at least 1")
+    if args.preview is not None and args.preview < 1:
+        parser.error("--preview must be a positive number of pixels")
+    if args.cmap not in matplotlib.colormaps:
+        parser.error(f"--cmap {args.cmap!r} is not a matplotlib colormap")
+    if args.window < 16 or args.window % 16:
+        parser.error("--window must be a positive multiple of 16, the block size of the GeoTIFFs")
+    if args.resolution not in ("finest", "coarsest"):
+        args.resolution = args.resolution.upper()
+        if args.resolution not in bands.RESOLUTIONS:
+            parser.error(f"--resolution must be finest, coarsest or one of {', '.join(sorted(bands.RESOLUTIONS))}")
+    try:
+        floating = np.dtype(args.dtype).kind == "f"
+    except TypeError:
+        floating = False
+    if not floating:
+        parser.error("--dtype must be a floating point type, e.g. float32 or float64")
+    if args.manifest is not None and not os.path.isfile(args.manifest):
+        parser.error(f"--manifest {args.manifest!r} does not exist")
+    args.scenes = scheduler.expand(args.scenes, args.manifest)
+    if not args.scenes:
+        parser.error("no scene folder found")
+    return args
+
+def product(kind: str, name: str, args):
+    '''
+    Returns the name of a product as recorded in the state file, e.g.
+    "index/ndvi?format=tif&encoding=float32&...", with every option that changes its file, so a
+    product done with other options or in another output folder is created again.
+    '''
+    options = {"output": os.path.abspath(args.output) if args.output else "", "dtype": args.dtype,
+               "resolution": args.resolution, "preview": args.preview, "stretch": args.stretch, "mask": args.mask}
+    if kind == "index":
+        options["format"] = args.format
+        if args.format == "tif":
+            options.update(encoding=args.encoding, compress=args.compress)
+        else:
+            options["cmap"] = args.cmap
+    return f"{kind}/{name}?" + "&".join(f"{key}={value}" for key, value in options.items())
+
+def products(args):
+    '''
+    Returns the names of the products requested in the command line, see product().
+    '''
+    return ([product("composite", name, args) for name in args.composite] +
+            [product("index", name, args) for name in args.index])
+
+def process(scene: str, args, pending=None):
+    '''
+    Description
+    -----------
+    Creates the requested compositions and indices of a scene.
+
+    Parameters
+    -----------
+    scene: str
+        Folder that contains the images of the scene.
+    args: Namespace
+        Arguments returned by parse().
+    pending: list, optional
+        Names of the products to create, as returned by products(). Default is None, which
+        creates all of the requested ones.
+
+    Returns
+    -------
+    outputs: dict
+        Dictionary that maps each product to the full path of its file.
+    '''
+    pending = products(args) if pending is None else pending
+    composites = [name for name in args.composite if product("composite", name, args) in pending]
+    names = [name for name in args.index if product("index", name, args) in pending]
+    images = read(1, 12, scene, dtype=args.dtype, resolution=args.resolution,
+                  cache=None if args.cache is None else cache.Cache(args.cache), preview=args.preview, stretch=args.stretch,
+                  mask=args.mask, threads=args.threads)
+    name = safe.name(scene)
+    path = args.output or safe.folder(scene)
+    folder = os.path.join(path, "Compositions")
+    os.makedirs(folder, exist_ok=True)
+    outputs = dict()
+    for composite in composites:
+        function, title = COMPOSITES[composite]
+        title = f"{name} {title}"
+        simple.create(function(images, dtype=args.dtype), title, save=True, path=path, display=False)
+        outputs[product("composite", composite, args)] = os.path.join(folder, f"{title}.png")
+    if args.format == "tif":
+        files = {index: os.path.join(folder, f"{name} {index.upper()}.tif") for index in names}
+        if files:
+            tiling.stream_many(images, files, args.window, args.workers, args.encoding, args.compress, args.stretch)
+        outputs.update({product("index", index, args): file for index, file in files.items()})
+    elif names:
+        for index, array in indices.batch(images, names, args.dtype, args.stretch).items():
+            title = f"{name} {index.upper()}"
+            indices.create(array, title, cmap=args.cmap, save=True, path=path, display=False)
+            outputs[product("index", index, args)] = os.path.join(folder, f"{title}.png")
+    return outputs
+
+def job(scene: str, pending, args):
+    '''
+    Creates the pending products of a scene for scheduler.run(), recording its metrics if they
+    were requested. It is defined at module level so the processes of the pool can run it.
+    '''
+    recorder = None
+    if args.metrics:
+        recorder = metrics.enable(memory=True, scene=safe.name(scene))
+    try:
+        outputs = process(scene, args, pending)
+    finally:
+        metrics.disable()
+    return outputs, recorder
+
+def main(argv=None):
+    '''
+    Processes every scene given in the command line. A scene that fails is reported and the
+    rest are still processed; the exit code is 1 if any scene failed.
+    '''
+    args = parse(argv)
+    recorders = list()
+    state = scheduler.State(args.state or ":memory:")
+    try:
+        failed = scheduler.run(args.scenes, products(args), partial(job, args=args), state, args.jobs,
+                               callback=lambda scene, recorder: recorder and recorders.append(recorder))
+    finally:
+        state.close()
+    if args.metrics:
+        metrics.write(recorders, args.metrics)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,568 @@
+import os
+import copy
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+from xml.sax.saxutils import escape
+import numpy as np
+import rasterio as rs
+from rasterio import dtypes
+from rasterio.enums import Resampling
+from functions import metrics
+from functions import normalize
+from functions import safe
+
+GREEN = "\u001B[32m"
+RESET = "\u001B[0m"
+
+# Band used as the reference grid for the resampling (10 m).
+REFERENCE = "B02"
+
+# Native resolution in meters of each band read by the program. B10 (cirrus) is left out: it is
+# only in Level-1C products and carries no surface information.
+RESOLUTIONS = {"B01": 60, "B02": 10, "B03": 10, "B04": 10, "B05": 20, "B06": 20, "B07": 20,
+               "B08": 10, "B8A": 20, "B09": 60, "B11": 20, "B12": 20}
+
+# Threads that read bands at the same time. GDAL releases the GIL while it decodes and
+# resamples, so the bands of an operation are read in about the time of the slowest one.
+THREADS = min(8, os.cpu_count() or 1)
+
+# Most bytes of arrays being read at the same time, so concurrent reads of large grids do not
+# exhaust the memory. A band larger than this is still read, alone.
+IN_FLIGHT = 2 << 30
+
+# Resampling of the bands brought to a grid finer than their own, instead of the one given to
+# Bands. The SWIR bands vary smoothly at 20 m, so bilinear keeps them as well as cubic does and
+# needs a smaller kernel. Bands brought to a coarser grid are always averaged.
+UPSAMPLING = {"B11": Resampling.bilinear, "B12": Resampling.bilinear}
+
+def band_code(file: str):
+    '''
+    Returns the band code of a file following the Sentinel-2 naming conventions,
+    e.g. "T14QLG_20230101_B8A.tif" -> "B8A".
+    '''
+    return f"B{file[-6:-4]}"
+
+def band_number(code: str):
+    '''
+    Returns the number of a band code, e.g. "B04" -> 4. The band B8A shares the number 8.
+    '''
+    return int(code[1:].rstrip("A"))
+
+def find(path: str, start=1, end=12):
+    '''
+    Description
+    -----------
+    Lists the TIF files of a directory and keeps the ones whose band number lies between
+    start and end (both included). A Sentinel-2 .SAFE directory or .zip archive can be given
+    instead, and its JP2 bands are found from its manifest, see safe.files().
+
+    Parameters
+    -----------
+    path: str
+        Full path of the directory in which the images are to be found, or of the product.
+    start: int
+        Starting number of the range of bands.
+    end: int
+        Ending number of the range of bands.
+
+    Returns
+    -------
+    files: dict
+        Dictionary that maps each band code to the full path of its file.
+    '''
+    files = dict()
+    if safe.is_product(path):
+        for code, file_path in safe.files(path, RESOLUTIONS).items():
+            try:
+                number = band_number(code)
+            except ValueError:
+                # SCL
+                continue
+            if start <= number <= end:
+                files[code] = file_path
+        return files
+    for file in sorted(os.listdir(path)):
+        if file.endswith(".tif"):
+            code = band_code(file)
+            try:
+                number = band_number(code)
+            except ValueError:
+                continue
+            if start <= number <= end:
+                files[code] = os.path.join(path, file)
+    return files
+
+def shape_of(file_path: str):
+    '''
+    Returns the (height, width) of a raster by reading its metadata only.
+    '''
+    with rs.open(file_path) as src:
+        return (src.height, src.width)
+
+def reduce(shape: tuple, size=None):
+    '''
+    Returns a shape scaled down, keeping its aspect ratio, so its largest side is at most size.
+    With size None, or a shape that is already small enough, the shape is returned as it is.
+    '''
+    if size is None or max(shape) <= size:
+        return tuple(shape)
+    factor = size / max(shape)
+    return tuple(max(1, round(side * factor)) for side in shape)
+
+def load(file_path: str, shape: tuple, resampling=Resampling.cubic, dtype="float32", stretch="max",
+         invalid=None):
+    '''
+    Description
+    -----------
+    Opens a band, decodes it resampled to the given shape and normalizes it by its maximum, or
+    by a high percentile with the "percentile" stretch. The file is opened once and closed as
+    soon as its data has been read. Masked pixels are set to NaN and left out of the
+    normalization, so clouds and nodata do not set its scale.
+
+    Parameters
+    -----------
+    file_path: str
+        Full path of the band file.
+    shape: tuple
+        (height, width) of the output grid.
+    resampling: Resampling, optional
+        Resampling method used when the band does not have the given shape. Default is cubic.
+    dtype: str, optional
+        Data type of the normalized band. Default is "float32".
+    stretch: str, optional
+        "max", or "percentile" to divide the band by its normalize.PERCENTILE percentile and
+        clip it to 1. Default is "max".
+    invalid: ndarray, optional
+        Boolean array with the given shape, True where the pixels are masked, as returned by
+        Mask.read(). Default is None.
+
+    Returns
+    -------
+    band, timings: ndarray, dict
+        Array of shape (1, height, width) and the time in seconds spent in each stage.
+    '''
+    with metrics.stage("open") as opening:
+        src = rs.open(file_path)
+    with src:
+        native = (src.height, src.width) == tuple(shape)
+        stage = "decode" if native else "decode+resample"
+        # Decodificación y remuestreo en una sola lectura de GDAL
+        with metrics.stage(stage) as decoding:
+            band = src.read(out_shape=(src.count, *shape), # out_shape=(bands, rows, columns)
+                            resampling=resampling)
+        metrics.count("bytes_read", src.count * src.height * src.width * np.dtype(src.dtypes[0]).itemsize)
+    # Normalización de los valores de la matriz
+    with metrics.stage("normalize") as normalizing:
+        band = _normalize(band, dtype, stretch, invalid)
+    timings = {"open": opening.seconds, stage: decoding.seconds, "normalize": normalizing.seconds}
+    return band, timings
+
+def _normalize(band, dtype, stretch, invalid):
+    # El percentil se calcula sobre los valores enteros, así es exacto
+    valid = band if invalid is None else band[:, ~invalid]
+    if valid.size == 0:
+        divisor = 1
+    elif stretch == "max":
+        divisor = np.amax(valid)
+    else:
+        divisor = normalize.Statistics().update(valid).divisor(stretch)
+    band = band.astype(dtype)
+    if invalid is not None:
+        band[:, invalid] = np.nan
+    return normalize.apply(band, divisor, stretch, out=band)
+
+def stack(file_paths):
+    '''
+    Description
+    -----------
+    Returns a virtual raster (VRT) whose bands are the given files, which must share their
+    native grid, so GDAL decodes and resamples all of them in a single multi-band read that
+    sets up the geometry of the resampling once. The bands are read with the data type of the
+    first file, and the nodata value of each file is kept, so its nodata pixels are left out of
+    the resampling as in a read of the file itself.
+
+    Parameters
+    -----------
+    file_paths: list
+        Full paths of the band files.
+
+    Returns
+    -------
+    vrt: str
+        XML of the VRT, which rasterio.open() accepts as a path.
+    '''
+    nodatas = list()
+    for file_path in file_paths:
+        with rs.open(file_path) as src:
+            nodatas.append(src.nodatavals[0])
+            if len(nodatas) == 1:
+                height, width, crs, transform = src.height, src.width, src.crs, src.transform
+                typename = dtypes.typename_fwd[dtypes.dtype_rev[src.dtypes[0]]]
+    srs = "" if crs is None else f"<SRS>{escape(crs.to_wkt())}</SRS>"
+    geotransform = ", ".join(repr(value) for value in transform.to_gdal())
+    sources = ""
+    for number, (file_path, nodata) in enumerate(zip(file_paths, nodatas), 1):
+        source = (f'<SourceFilename relativeToVRT="0">{escape(file_path)}</SourceFilename>'
+                  f'<SourceBand>1</SourceBand>')
+        if nodata is None:
+            source = f'<SimpleSource>{source}</SimpleSource>'
+        else:
+            # Sin el nodata, GDAL mezclaría sus píxeles con los vecinos al remuestrear
+            source = (f'<NoDataValue>{nodata!r}</NoDataValue>'
+                      f'<ComplexSource>{source}<NODATA>{nodata!r}</NODATA></ComplexSource>')
+        sources += f'<VRTRasterBand dataType="{typename}" band="{number}">{source}</VRTRasterBand>'
+    return (f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">{srs}'
+            f'<GeoTransform>{geotransform}</GeoTransform>{sources}</VRTDataset>')
+
+def load_group(file_paths, shape: tuple, resampling=Resampling.cubic, dtype="float32", stretch="max",
+               invalid=None):
+    '''
+    Description
+    -----------
+    Loads several bands that share a native grid as load() does, but decodes and resamples them
+    together, in one multi-band read of a VRT that stacks them (see stack()), and then
+    normalizes each one by its own maximum or percentile. The values are the same as those of
+    load().
+
+    Parameters
+    -----------
+    file_paths: list
+        Full paths of the band files.
+    shape: tuple
+        (height, width) of the output grid.
+    resampling: Resampling, optional
+        Resampling method used when the bands do not have the given shape. Default is cubic.
+    dtype: str, optional
+        Data type of the normalized bands. Default is "float32".
+    stretch: str, optional
+        "max" or "percentile", see load(). Default is "max".
+    invalid: ndarray, optional
+        Boolean array with the given shape, True where the pixels are masked. Default is None.
+
+    Returns
+    -------
+    bands, timings: list, dict
+        Arrays of shape (1, height, width), in the order of file_paths, and the time in seconds
+        spent in each stage by the whole group.
+    '''
+    with metrics.stage("open") as opening:
+        src = rs.open(stack(file_paths))
+    with src:
+        native = (src.height, src.width) == tuple(shape)
+        stage = "decode" if native else "decode+resample"
+        with metrics.stage(stage) as decoding:
+            block = src.read(out_shape=(src.count, *shape), resampling=resampling)
+        metrics.count("bytes_read", src.count * src.height * src.width * np.dtype(src.dtypes[0]).itemsize)
+    with metrics.stage("normalize") as normalizing:
+        loaded = [_normalize(block[number:number + 1], dtype, stretch, invalid) for number in range(src.count)]
+    timings = {"open": opening.seconds, stage: decoding.seconds, "normalize": normalizing.seconds}
+    return loaded, timings
+
+def report(code: str, timings: dict):
+    '''
+    Prints the timings of a band returned by load(), or of a group returned by load_group().
+    '''
+    stages = ", ".join(f"{stage} {round(t, 4)} s" for stage, t in timings.items())
+    print(f"{GREEN}{code}: {stages}{RESET}")
+
+class Budget:
+    '''
+    Description
+    -----------
+    Limit on the bytes being read at the same time by several threads. A thread reserves the
+    bytes of its read and waits while they do not fit in what is left; a read larger than the
+    whole limit waits until nothing else is being read.
+
+    Parameters
+    -----------
+    limit: int
+        Most bytes in flight.
+    '''
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int):
+        '''
+        Holds size bytes of the limit while the with block runs.
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= size
+                self._condition.notify_all()
+
+class Bands(Mapping):
+    '''
+    Description
+    -----------
+    Read-only dictionary of bands that reads, resamples and normalizes each band the first time
+    it is accessed and keeps the result, so bands that are never used are never read.
+    It can be indexed like the dictionary previously returned by read(), e.g. bands["B08"].
+
+    The bands are resampled to the grid given by shape. A resolution policy can be set so that
+    compositions and indices ask for the grid they actually need through grid(): the finest or
+    the coarsest native grid among the bands they use, or the grid of a given band. This way an
+    index of 20 m bands, such as the NDMI, is computed on the 20 m grid instead of on the 10 m one.
+
+    Parameters
+    -----------
+    files: dict
+        Dictionary that maps each band code to the full path of its file, as returned by find().
+    shape: tuple
+        (height, width) of the grid every band is resampled to.
+    resampling: Resampling, optional
+        Resampling method. Default is cubic. Bands brought to a coarser grid are averaged, and
+        the ones in methods use their own method when brought to a finer one, see method().
+    dtype: str, optional
+        Data type of the normalized bands. Default is "float32".
+    resolution: str, optional
+        Resolution policy used by grid(): "finest", "coarsest", a band code such as "B11", or
+        None to always use shape. Default is None.
+    cache: Cache, optional
+        On-disk cache of resampled bands. Bands found in it are memory-mapped instead of being
+        read and resampled again, and new bands are saved to it. Default is None.
+    preview: int, optional
+        Largest side in pixels of the native grids used by grid(), for quicklooks. The bands are
+        then read with a reduced out_shape, which GDAL serves from the internal overviews when
+        the files have them. shape should be reduced the same way. Default is None.
+    stretch: str, optional
+        Normalization of the bands, "max" or "percentile", see load(). Default is "max".
+    mask: Mask, optional
+        Pixels set to NaN in every band and left out of its normalization, e.g. clouds from the
+        SCL band (see functions/mask.py). Default is None.
+    verbose: bool, optional
+        Whether to print the timings of each band when it is loaded. Default is True.
+    threads: int, optional
+        Threads used by prefetch() to read the bands of an operation at the same time; 1 reads
+        them one after another. Default is THREADS.
+    in_flight: int, optional
+        Most bytes of bands being read at the same time by prefetch(). Default is IN_FLIGHT.
+    methods: dict, optional
+        Resampling of some bands, by code, when they are brought to a finer grid. Default is
+        UPSAMPLING; an empty dictionary uses resampling for every band.
+
+    Examples
+    --------
+    >>> images = Bands(find(path), shape_of(find(path)["B02"]))
+    >>> ndvi = indices.ndvi(images) # only B04 and B08 are read
+    >>> images = Bands(find(path), shape_of(find(path)["B02"]), resolution="finest")
+    >>> ndmi = indices.ndmi(images) # B8A and B11 are read at 20 m
+    >>> images.prefetch(["B02", "B03", "B04"]) # read at the same time by several threads
+    '''
+
+    def __init__(self, files: dict, shape: tuple, resampling=Resampling.cubic, dtype="float32",
+                 resolution=None, cache=None, preview=None, verbose=True, stretch="max", mask=None,
+                 threads=THREADS, in_flight=IN_FLIGHT, methods=UPSAMPLING):
+        self.files = dict(files)
+        self.shape = tuple(shape)
+        self.resampling = resampling
+        self.dtype = np.dtype(dtype)
+        self.resolution = resolution
+        self.cache = cache
+        self.preview = preview
+        self.verbose = verbose
+        self.stretch = stretch
+        self.mask = mask
+        self.threads = threads
+        self.methods = dict(methods)
+        # Compartido por las vistas de grid()
+        self._budget = Budget(in_flight)
+        # Bandas leídas, por código y dimensiones de la malla
+        self._loaded = dict()
+        self._native = dict()
+
+    def __getitem__(self, code):
+        key = (code, self.shape)
+        if key not in self._loaded:
+            self._read([code])
+        return self._loaded[key]
+
+    def _read(self, codes):
+        # Lee bandas con la misma malla nativa y el mismo remuestreo, las del caché por separado
+        resampling = self.method(codes[0])
+        options = {"stretch": self.stretch, "mask": None if self.mask is None else self.mask.key()}
+        missing = list()
+        for code in codes:
+            band = None
+            if self.cache is not None:
+                with metrics.stage("cache") as reading:
+                    band = self.cache.get(self.files[code], self.shape, resampling, self.dtype, **options)
+            if band is None:
+                missing.append(code)
+                continue
+            if self.verbose:
+                report(code, {"cache": reading.seconds})
+            self._loaded[(code, self.shape)] = band
+        if not missing:
+            return
+        invalid = None if self.mask is None else self.mask.read(self.shape)
+        paths = [self.files[code] for code in missing]
+        # Matrices leídas y normalizadas; el tipo nativo nunca es mayor que el de cálculo
+        size = 2 * len(missing) * self.shape[0] * self.shape[1] * self.dtype.itemsize
+        with self._budget.reserve(size):
+            if len(missing) == 1:
+                band, timings = load(paths[0], self.shape, resampling, self.dtype, self.stretch, invalid)
+                loaded = [band]
+            else:
+                loaded, timings = load_group(paths, self.shape, resampling, self.dtype, self.stretch, invalid)
+        if self.verbose:
+            report(", ".join(missing), timings)
+        for code, file_path, band in zip(missing, paths, loaded):
+            if self.cache is not None:
+                band = self.cache.put(file_path, self.shape, resampling, self.dtype, band, **options)
+            self._loaded[(code, self.shape)] = band
+
+    def __contains__(self, code):
+        return code in self.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def method(self, code: str):
+        '''
+        Description
+        -----------
+        Returns the resampling used to bring a band to the grid of this object: an average when
+        the grid is coarser than the native one of the band, so every native pixel counts, the
+        method of the band in methods when it is finer, and resampling otherwise. Previews always
+        use resampling.
+
+        Parameters
+        -----------
+        code: str
+            Code of the band.
+
+        Returns
+        -------
+        resampling: Resampling
+            Resampling method.
+        '''
+        if self.preview is not None:
+            return self.resampling
+        height, width = self.native_shape(code)
+        if self.shape[0] * self.shape[1] < height * width:
+            return Resampling.average
+        if self.shape[0] * self.shape[1] > height * width:
+            return self.methods.get(code, self.resampling)
+        return self.resampling
+
+    def prefetch(self, codes):
+        '''
+        Description
+        -----------
+        Reads on the grid of this object the given bands that have not been read yet. The bands
+        that must be resampled are read in groups with the same native grid and resampling, each
+        group in a single multi-band read (see load_group()), and the groups and the bands that
+        are already on the grid are read at the same time with up to threads threads and at most
+        in_flight bytes being read at once, so reading the bands of an operation takes about as
+        long as reading the slowest of them.
+
+        Parameters
+        -----------
+        codes: iterable
+            Codes of the bands, e.g. ("B02", "B03", "B04").
+        '''
+        missing = [code for code in dict.fromkeys(codes)
+                   if code in self.files and (code, self.shape) not in self._loaded]
+        groups = dict()
+        for code in missing:
+            native = self.native_shape(code)
+            if native == self.shape or self.preview is not None:
+                # Sin remuestreo no hay nada que compartir; se decodifican en paralelo
+                groups[code] = [code]
+            else:
+                groups.setdefault((native, self.method(code)), list()).append(code)
+        tasks = list(groups.values())
+        if self.mask is not None and tasks:
+            # Se lee una sola vez antes de repartir las bandas
+            self.mask.read(self.shape)
+        if self.threads <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                self._read(task)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.threads, len(tasks))) as pool:
+            for _ in pool.map(self._read, tasks):
+                pass
+
+    def native_shape(self, code: str):
+        '''
+        Returns the (height, width) of a band at its native resolution, read from its metadata,
+        reduced to the preview size if one is set.
+        '''
+        if code not in self._native:
+            self._native[code] = reduce(shape_of(self.files[code]), self.preview)
+        return self._native[code]
+
+    def target(self, names):
+        '''
+        Description
+        -----------
+        Returns the shape of the grid an operation on the given bands should be computed on,
+        according to the resolution policy.
+
+        Parameters
+        -----------
+        names: iterable
+            Codes of the bands used by the operation, e.g. ("B8A", "B11").
+
+        Returns
+        -------
+        shape: tuple
+            (height, width) of the grid.
+        '''
+        if self.resolution is None:
+            return self.shape
+        if self.resolution in ("finest", "coarsest"):
+            choose = max if self.resolution == "finest" else min
+            return choose((self.native_shape(code) for code in names), key=lambda s: s[0] * s[1])
+        return self.native_shape(self.resolution)
+
+    def grid(self, names):
+        '''
+        Description
+        -----------
+        Returns a view of the bands resampled to the grid chosen by target(). The view shares the
+        bands already read, so a band is never read twice for the same grid.
+
+        Parameters
+        -----------
+        names: iterable
+            Codes of the bands used by the operation.
+
+        Returns
+        -------
+        bands: Bands
+            Bands whose shape is the chosen grid.
+        '''
+        shape = self.target(names)
+        if shape == self.shape and self.resolution is None:
+            return self
+        view = copy.copy(self)
+        view.shape = shape
+        view.resolution = None
+        return view
+
+def on_grid(dictionary, names, prefetch=False):
+    '''
+    Returns the bands on the grid needed by an operation on the given band codes, with prefetch
+    reading them all at once with Bands.prefetch(). Plain dictionaries are returned as they are.
+    '''
+    if isinstance(dictionary, Bands):
+        grid = dictionary.grid(names)
+        if prefetch:
+            grid.prefetch(names)
+        return grid
+    return dictionary
@@ -0,0 +1,157 @@
+import os
+import threading
+import hashlib
+import argparse
+import numpy as np
+from functions import normalize
+from functions import safe
+
+# Default directory and size limit of the cache. Both can be changed with the environment
+# variables S2_CACHE_DIR and S2_CACHE_SIZE (in bytes).
+DIRECTORY = os.environ.get("S2_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sentinel-2"))
+SIZE = int(os.environ.get("S2_CACHE_SIZE", 20 * 1024**3))
+
+def _digest(text: str):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+class Cache:
+    '''
+    Description
+    -----------
+    On-disk cache of resampled and normalized bands. Each band is saved as a .npy file and read
+    back as a read-only memory-mapped array, so later runs and other processes reuse it without
+    copying it into memory nor resampling it again.
+
+    The entries are identified by the source file path, its modification time, the target shape,
+    the resampling method, the data type, the stretch and the mask, so modifying a band or asking
+    for a different grid never returns stale data. When the total size goes over the limit, the least
+    recently used entries are removed.
+
+    Parameters
+    -----------
+    directory: str, optional
+        Directory where the arrays are saved. Default is DIRECTORY.
+    size: int, optional
+        Maximum size of the cache in bytes. Default is SIZE.
+
+    Examples
+    --------
+    >>> images = read(1, 12, path, cache=Cache())
+    '''
+
+    def __init__(self, directory=DIRECTORY, size=SIZE):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, file_path: str, shape: tuple, resampling, dtype, stretch="max", mask=None):
+        # Las bandas de un .zip cambian con el archivo
+        modified = os.stat(safe.local(file_path)).st_mtime_ns
+        # El nombre empieza con el hash de la ruta para poder invalidar todas sus entradas
+        file_path = os.path.abspath(file_path)
+        key = f"{modified}|{tuple(shape)}|{resampling.name}|{np.dtype(dtype).str}"
+        if stretch != "max":
+            key += f"|{stretch}{normalize.PERCENTILE}"
+        if mask is not None:
+            key += f"|{mask}"
+        return os.path.join(self.directory, f"{_digest(file_path)}-{_digest(key)}.npy")
+
+    def get(self, file_path: str, shape: tuple, resampling, dtype, stretch="max", mask=None):
+        '''
+        Returns the cached band as a read-only memory-mapped array, or None if it is not cached.
+        '''
+        cached = self._file(file_path, shape, resampling, dtype, stretch, mask)
+        try:
+            band = np.load(cached, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        # Actualiza la fecha de uso para el desalojo LRU; si otro proceso acaba de desalojarla,
+        # el arreglo ya mapeado sigue siendo válido
+        try:
+            os.utime(cached)
+        except FileNotFoundError:
+            pass
+        return band
+
+    def put(self, file_path: str, shape: tuple, resampling, dtype, band, stretch="max", mask=None):
+        '''
+        Saves a band and returns it memory-mapped from the cache. The file is written under a
+        temporary name and renamed, so other processes never see a partially written array. If
+        another process evicts it before it is mapped, the band given is returned.
+        '''
+        cached = self._file(file_path, shape, resampling, dtype, stretch, mask)
+        temporary = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as file:
+            np.save(file, band)
+        os.replace(temporary, cached)
+        try:
+            band = np.load(cached, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            # Desalojada por otro proceso antes de mapearla; se devuelve la que está en memoria
+            return band
+        self.evict()
+        return band
+
+    def entries(self):
+        '''
+        Returns the (path, size, last use) of every entry, from the least to the most recently used.
+        '''
+        entries = list()
+        for file in os.listdir(self.directory):
+            if file.endswith(".npy"):
+                file_path = os.path.join(self.directory, file)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((file_path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in its size limit.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for file_path, size, _ in entries:
+            if total <= self.size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                # Ya borrado por otro proceso, o todavía mapeado en Windows
+                continue
+            total -= size
+
+    def invalidate(self, file_path=None):
+        '''
+        Description
+        -----------
+        Removes the cached arrays of a source file, or every cached array.
+
+        Parameters
+        -----------
+        file_path: str, optional
+            Full path of a band file. Default is None, which clears the whole cache.
+
+        Returns
+        -------
+        removed: int
+            Number of removed entries.
+        '''
+        prefix = "" if file_path is None else f"{_digest(os.path.abspath(file_path))}-"
+        removed = 0
+        for cached, _, _ in self.entries():
+            if os.path.basename(cached).startswith(prefix):
+                os.remove(cached)
+                removed += 1
+        return removed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the cache of resampled bands.")
+    parser.add_argument("files", nargs="*", help="band files to invalidate; all the cache if omitted")
+    parser.add_argument("--directory", default=DIRECTORY, help="directory of the cache")
+    args = parser.parse_args()
+    cache = Cache(args.directory)
+    removed = sum(cache.invalidate(file) for file in args.files) if args.files else cache.invalidate()
+    print(f"{removed} cached bands removed from {cache.directory}")
@@ -0,0 +1,192 @@
+import ast
+import numpy as np
+
+# Number of pixels evaluated at once. The temporary buffers of a formula are this size, so they
+# stay in cache and are reused for every chunk instead of allocating full-size arrays.
+CHUNK = 65536
+
+# Value of the pixels where a formula divides by zero, e.g. the NDVI where B08 + B04 = 0. NaN is
+# left out of the normalization and written as the nodata value of the GeoTIFFs.
+NODATA = np.nan
+
+_BINARY = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.divide, ast.Pow: np.power}
+_UNARY = {ast.USub: np.negative, ast.UAdd: np.positive}
+_CALLS = {"abs": np.absolute}
+def _divide(numerator, denominator, out, valid, nodata):
+    # División sin infinitos ni avisos: donde el denominador es cero se escribe el nodata
+    np.not_equal(denominator, 0, out=valid)
+    np.divide(numerator, denominator, out=out, where=valid)
+    np.logical_not(valid, out=valid)
+    np.copyto(out, nodata, where=valid)
+
+_FOLD = {ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b,
+         ast.Div: lambda a, b: a / b, ast.Pow: lambda a, b: a ** b}
+
+class Expression:
+    '''
+    Description
+    -----------
+    Band formula compiled once into a list of numpy ufunc calls that are evaluated chunk by
+    chunk over preallocated buffers. Instead of building a full-size temporary for every
+    operation, each chunk of the bands goes through the whole formula before the next one is
+    read, and the result is written straight into the output array.
+
+    The formula is written with Sentinel-2 band codes, numbers, +, -, *, /, ** and abs(), e.g.
+    "(B08 - B04) / (B08 + B04)". Operations between numbers are computed once when compiling,
+    and repeated subexpressions, such as B08 + B04, are computed once per chunk.
+
+    Several formulas can be compiled together. They are then evaluated in the same pass over
+    the bands and share their subexpressions.
+
+    Divisions are safe: where the denominator is zero the result is NODATA instead of an
+    infinity, without numpy warnings, and pixels that are NaN in a band stay NaN.
+
+    Parameters
+    -----------
+    formulas: str or list
+        Formula of the index, or list of formulas.
+
+    Attributes
+    ----------
+    bands: tuple
+        Codes of the bands used by the formula, in order of appearance.
+
+    Examples
+    --------
+    >>> ndvi = Expression("(B08 - B04) / (B08 + B04)")
+    >>> index = ndvi.evaluate(images, maxima={"B08": 0.9, "B04": 0.7})
+    >>> both = Expression(["(B08 - B04) / (B08 + B04)", "(B08 - B11) / (B08 + B11)"])
+    >>> ndvi, ndmi = both.evaluate(images)
+    '''
+
+    def __init__(self, formulas):
+        self.single = isinstance(formulas, str)
+        self.formulas = (formulas,) if self.single else tuple(formulas)
+        self.program = list()
+        self._registers = dict()
+        self._seen = dict()
+        self._count = 0
+        self.results = list()
+        for formula in self.formulas:
+            self.formula = formula
+            result = self._compile(ast.parse(formula, mode="eval").body)
+            if not isinstance(result, int):
+                raise ValueError(f"The formula {formula!r} does not use any band")
+            self.results.append(result)
+        self.formula = self.formulas[0] if self.single else self.formulas
+        self.bands = tuple(self._registers)
+
+    def __repr__(self):
+        return f"Expression({self.formula!r})"
+
+    def _register(self):
+        self._count += 1
+        return self._count - 1
+
+    def _compile(self, node):
+        # Devuelve el índice del registro con el resultado del nodo, o un número si es constante
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return float(node.value)
+        if isinstance(node, ast.Name):
+            if node.id not in self._registers:
+                self._registers[node.id] = self._register()
+            return self._registers[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            left, right = self._compile(node.left), self._compile(node.right)
+            if isinstance(left, float) and isinstance(right, float):
+                return float(_FOLD[type(node.op)](left, right))
+            return self._emit(_BINARY[type(node.op)], left, right)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+            operand = self._compile(node.operand)
+            if isinstance(operand, float):
+                return -operand if isinstance(node.op, ast.USub) else operand
+            return self._emit(_UNARY[type(node.op)], operand)
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _CALLS
+                and len(node.args) == 1 and not node.keywords):
+            operand = self._compile(node.args[0])
+            if isinstance(operand, float):
+                return abs(operand)
+            return self._emit(_CALLS[node.func.id], operand)
+        raise ValueError(f"Unsupported element in formula {self.formula!r}: {ast.dump(node)}")
+
+    def _emit(self, function, *operands):
+        # Las subexpresiones repetidas reutilizan el registro de la primera
+        key = (function, tuple((isinstance(o, int), o) for o in operands))
+        if key not in self._seen:
+            self._seen[key] = self._register()
+            self.program.append((function, self._seen[key], operands))
+        return self._seen[key]
+
+    def evaluate(self, bands, maxima=None, out=None, dtype="float32", nodata=NODATA):
+        '''
+        Description
+        -----------
+        Evaluates the formula, or all the formulas, over arrays of bands with the same shape.
+
+        Parameters
+        -----------
+        bands: dict
+            Dictionary that contains at least the bands used by the formula.
+        maxima: dict, optional
+            Value each band is divided by before applying the formula, by band code. The
+            division is done chunk by chunk, so the normalized bands are never stored whole.
+            Default is None, which uses the bands as they are.
+        out: ndarray or list, optional
+            C-contiguous array with the shape of the bands where the result is written, or one
+            such array per formula; any other raises a ValueError. Default is None, which
+            allocates them.
+        dtype: str, optional
+            Data type used for the computation. Default is "float32".
+        nodata: float, optional
+            Value written where a formula divides by zero. Default is NODATA.
+
+        Returns
+        -------
+        index: ndarray or list
+            Array with the shape of the bands containing the result of the formula, or list with
+            one array per formula when several were compiled.
+        '''
+        dtype = np.dtype(dtype)
+        sources = [np.asarray(bands[code]) for code in self.bands]
+        shape = sources[0].shape
+        if out is None:
+            out = [np.empty(shape, dtype) for _ in self.results]
+        elif self.single:
+            out = [out]
+        for array in out:
+            # reshape(-1) copiaría un arreglo no contiguo y el resultado se perdería
+            if array.shape != shape:
+                raise ValueError(f"out has shape {array.shape}, the bands have shape {shape}")
+            if not array.flags.c_contiguous:
+                raise ValueError("out must be C-contiguous, e.g. not a strided view")
+        flat = [array.reshape(-1) for array in out]
+        sources = [source.reshape(-1) for source in sources]
+        divisors = [None if maxima is None else dtype.type(maxima[code]) for code in self.bands]
+        nodata = dtype.type(nodata)
+        program = [(function, target, [o if isinstance(o, int) else dtype.type(o) for o in operands])
+                   for function, target, operands in self.program]
+        size = flat[0].size
+        chunk = max(1, min(CHUNK, size))
+        buffers = [np.empty(chunk, dtype) for _ in range(self._count)]
+        # Máscara de los denominadores distintos de cero, reutilizada por cada división
+        valid = np.empty(chunk, dtype=bool)
+        for start in range(0, size, chunk):
+            stop = min(start + chunk, size)
+            registers = [buffer[:stop - start] for buffer in buffers]
+            for register, source, divisor in zip(self._registers.values(), sources, divisors):
+                if divisor is None:
+                    registers[register][...] = source[start:stop]
+                elif divisor == 0:
+                    registers[register][...] = nodata
+                else:
+                    np.divide(source[start:stop], divisor, out=registers[register])
+            for function, target, operands in program:
+                arguments = [registers[o] if isinstance(o, int) else o for o in operands]
+                if function is np.divide:
+                    _divide(*arguments, registers[target], valid[:stop - start], nodata)
+                else:
+                    function(*arguments, out=registers[target])
+            for array, result in zip(flat, self.results):
+                array[start:stop] = registers[result]
+        return out[0] if self.single else out
@@ -1,12 +1,17 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+from functions.bands import on_grid
+from functions import render
+from functions import metrics
+from functions import normalize
+from functions.expression import Expression
 
 # BAND INDICES
 # see
 # https://acolita.com/lista-de-indices-espectrales-en-sentinel-2-y-landsat/
 
-def create(array: any, title: str, cmap="viridis", save=False, path=None):
+def create(array: any, title: str, cmap=None, save=False, path=None, display=None):
     '''
     Display the image in a matplotlib subplot with its respective colorbar.
 
@@ -16,11 +21,18 @@ def create(array: any, title: str, cmap="viridis", save=False, path=None):
         2D array containing the image data.
     title: str
         Name of the composition.
+    cmap: str, optional
+        Name of the matplotlib colormap. Default is None, which asks the user for it.
     save: bool
         Wether the user wants to save the image or not.
     path: str
         Path where the folder "Compositions" will be created.
         Default is the same path where the images are saved.
+    display: bool, optional
+        Whether to display the saved image. Default is None, which asks the user for it.
+        With False, nothing is displayed nor asked, so it can be used without a screen, and the
+        saved image is a quicklook rendered by functions/render.py instead of a matplotlib figure:
+        it is much faster and lighter, but has no title.
 
     Notes
     -----
@@ -34,7 +46,13 @@ def create(array: any, title: str, cmap="viridis", save=False, path=None):
     >>> image = image.read(1)
     >>> indices.create(image, 'NDVI', cmap='viridis', save=False, path=None)
     '''
-    cmap = input("Which colormap would you like to use? Or press Enter to use default: ")
+    if save == True and path != None and display is False:
+        # Sin pantalla: vista rápida sin pasar por matplotlib
+        os.makedirs(os.path.join(path, "Compositions"), exist_ok=True)
+        render.save(render.colorize(array, cmap or "viridis"), os.path.join(path, "Compositions", f"{title}.png"))
+        return
+    if cmap is None:
+        cmap = input("Which colormap would you like to use? Or press Enter to use default: ")
     if cmap == "":
         # cmap = 'viridis'
         plt.imshow(array)
@@ -44,14 +62,163 @@ def create(array: any, title: str, cmap="viridis", save=False, path=None):
     plt.colorbar()
     plt.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
     if save == True and path != None:
-        plt.savefig(f"{path}\Compositions\{title}.png", dpi=400)
-        display = input("Display image? (Y/N): ")
-        if display == 'Y' or display == 'Y'.lower():
+        os.makedirs(os.path.join(path, "Compositions"), exist_ok=True)
+        plt.savefig(os.path.join(path, "Compositions", f"{title}.png"), dpi=400)
+        if display is None:
+            display = input("Display image? (Y/N): ") in ("Y", "y")
+        if display:
             plt.show()
+        else:
+            plt.close()
+    elif display is False:
+        plt.close()
     else: 
         plt.show()
         
-def ndvi(dictionary):
+# Formula of each index, written with the band codes. The bands are normalized by their
+# maximum before the formula is applied. The formulas are compiled once and shared by the
+# in-memory functions below and by the windowed computation in functions/tiling.py. Where a
+# formula divides by zero, e.g. the SIPI where B08 = B04, the index is NaN (expression.NODATA).
+INDICES = {
+    "ndvi": "(B08 - B04) / (B08 + B04)",
+    "ndmi": "(B8A - B11) / (B8A + B11)",
+    "gndvi": "(B08 - B03) / (B08 + B03)",
+    # BUG: It does not work
+    # G = 2.5 / 9, C1 = 6 / 9, C2 = 7.5 / 9, L = 1 / 9
+    "evi": "(2.5 / 9) * ((B08 - B04) / (B08 + (6 / 9) * B04 - (7.5 / 9) * B02 + (1 / 9)))",
+    "avi": "abs((B08 * (1 - B04) * (B08 - B04))) ** (1 / 3)",
+    "savi": "abs(((B08 - B04) / (B08 + B04 + 0.428))) * (1.428)",
+    "wsi": "(B11 / B08) * 1.25",
+    "gci": "(B09 / B03) - 1",
+    "nbri": "(B08 - B12) / (B08 + B12)",
+    "bsi": "((B11 + B04) - (B08 + B02)) / ((B11 + B04) + (B08 + B02))",
+    "ndwi": "(B03 - B08) / (B03 + B08)",
+    "ndsi": "(B03 - B11) / (B03 + B11)",
+    "ndgi": "(B03 - B04) / (B03 + B04)",
+    "arvi": "(B08 - (2 * B04) + B02) / (B08 + (2 * B04) + B02)",
+    "sipi": "((B08 - B02) / (B08 - B04)) * 1E+6",
+    "bndi": "(B11 - B08) / (B11 + B08)",
+}
+FORMULAS = {name: Expression(formula) for name, formula in INDICES.items()}
+
+def register(name: str, formula: str):
+    '''
+    Description
+    -----------
+    Registers a new index, or replaces an existing one, so it can be used by compute() and by
+    the windowed computation.
+
+    Parameters 
+    ----------- 
+    name: str
+        Name of the index, e.g. "ndre".
+    formula: str
+        Formula of the index written with the band codes, e.g. "(B8A - B05) / (B8A + B05)".
+
+    Examples
+    --------
+    >>> indices.register("ndre", "(B8A - B05) / (B8A + B05)")
+    >>> index = indices.compute(images, "ndre")
+    '''
+    FORMULAS[name] = Expression(formula)
+    INDICES[name] = formula
+
+def compute(dictionary, name: str, dtype="float32", stretch="max"):
+    '''
+    Description
+    -----------
+    Normalizes the bands used by an index, applies its formula and normalizes the result.
+    The normalization of the bands and the formula are evaluated in a single pass over the
+    bands, chunk by chunk, so no full-size temporary is created besides the result.
+    When the bands are a Bands object, the index is computed on the grid chosen by its
+    resolution policy.
+
+    Parameters 
+    ----------- 
+    dictionary: dict
+        Dictionary that contains the bands.
+    name: str
+        Name of the index as registered in INDICES, e.g. "ndvi".
+    dtype: str, optional
+        Data type used for the computation. Sentinel-2 reflectances have 12 to 15 bits,
+        so float32 keeps their precision with half the memory of float64. Default is "float32".
+    stretch: str, optional
+        Normalization of the result: "max" divides it by its maximum, "percentile" by its
+        normalize.PERCENTILE percentile, clipping the values above it to 1, so a few hot pixels
+        do not compress the whole range. The bands are normalized by the Bands object that
+        reads them. Default is "max".
+        
+    Returns      
+    -------
+    index: ndarray
+        Array containing the values of the index.
+    '''
+    formula = FORMULAS[name]
+    dictionary = on_grid(dictionary, formula.bands, prefetch=True)
+    maxima = {band: _maximum(dictionary[band]) for band in formula.bands}
+    with metrics.stage("index"):
+        index = formula.evaluate(dictionary, maxima, dtype=dtype)
+        normalize.apply(index, _divisor(index, stretch), stretch, out=index)
+    return index[0]
+
+def _maximum(array):
+    # Máximo sin NaN y sin copiar la banda; una escena enmascarada entera da 0, que se
+    # escribe como nodata
+    maximum = np.fmax.reduce(array, axis=None)
+    return 0 if np.isnan(maximum) else maximum
+
+def _divisor(index, stretch):
+    # El máximo no necesita histograma; los píxeles enmascarados son NaN
+    if stretch == "max":
+        return _maximum(index)
+    return normalize.Statistics().update(index).divisor(stretch)
+
+def batch(dictionary, names, dtype="float32", stretch="max"):
+    '''
+    Description
+    -----------
+    Computes several indices in one pass over their bands. The bands shared by the indices are
+    read and their maximum is computed only once, and the formulas of the indices computed on
+    the same grid are evaluated together, so common subexpressions such as B08 + B04 are
+    computed once per chunk.
+
+    Parameters 
+    ----------- 
+    dictionary: dict
+        Dictionary that contains the bands.
+    names: list
+        Names of the indices as registered in INDICES, e.g. ["ndvi", "ndmi", "nbri"].
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    stretch: str, optional
+        Normalization of the results, "max" or "percentile", see compute(). Default is "max".
+        
+    Returns      
+    -------
+    indices: dict
+        Dictionary that maps each name to the array containing the values of its index.
+
+    Examples
+    --------
+    >>> results = indices.batch(images, ["ndvi", "ndmi", "nbri", "ndwi", "bsi"])
+    >>> indices.create(results["ndvi"], "NDVI")
+    '''
+    groups = dict()
+    for name in names:
+        grid = on_grid(dictionary, FORMULAS[name].bands)
+        groups.setdefault(getattr(grid, "shape", None), (grid, list()))[1].append(name)
+    results = dict()
+    for grid, group in groups.values():
+        formula = Expression([INDICES[name] for name in group])
+        grid = on_grid(grid, formula.bands, prefetch=True)
+        maxima = {band: _maximum(grid[band]) for band in formula.bands}
+        with metrics.stage("index"):
+            for name, index in zip(group, formula.evaluate(grid, maxima, dtype=dtype)):
+                normalize.apply(index, _divisor(index, stretch), stretch, out=index)
+                results[name] = index[0]
+    return results
+
+def ndvi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -70,6 +237,8 @@ def ndvi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -82,13 +251,9 @@ def ndvi(dictionary):
 
     '''
 
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"])
-    index = (b8-b4) / (b8+b4)
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "ndvi", dtype)
 
-def ndmi(dictionary):
+def ndmi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -105,6 +270,8 @@ def ndmi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -116,13 +283,10 @@ def ndmi(dictionary):
     https://www.usgs.gov/landsat-missions/normalized-difference-moisture-index
 
     '''
-    b8a = dictionary["B8A"] / np.amax(dictionary["B8A"])
-    b11 = dictionary["B11"] / np.amax(dictionary["B11"])
-    index = (b8a-b11) / (b8a+b11)
-    index = index / np.amax(index)
-    return index[0]
 
-def gndvi(dictionary):
+    return compute(dictionary, "ndmi", dtype)
+
+def gndvi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -142,6 +306,8 @@ def gndvi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -154,13 +320,9 @@ def gndvi(dictionary):
 
     '''
 
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b3 = dictionary["B03"] / np.amax(dictionary["B03"])
-    index = (b8-b3) / (b8+b3)
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "gndvi", dtype)
 
-def evi(dictionary):
+def evi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -181,6 +343,8 @@ def evi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -192,20 +356,10 @@ def evi(dictionary):
     https://www.usgs.gov/landsat-missions/landsat-enhanced-vegetation-index?qt-science_support_page_related_con=0#qt-science_support_page_related_con
 
     '''
-    # BUG: It does not work
-    
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"])
-    b2 = dictionary["B02"] / np.amax(dictionary["B02"])
-    C1 = 6 / 9
-    C2 = 7.5 / 9
-    L = 1 / 9
-    G = 2.5 / 9
-    index = G * ((b8 - b4) / (b8 + C1 * b4 - C2 * b2 + L))
-    index = index / np.amax(index)
-    return index[0]
 
-def avi(dictionary):
+    return compute(dictionary, "evi", dtype)
+
+def avi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -224,6 +378,8 @@ def avi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -235,14 +391,10 @@ def avi(dictionary):
     https://www.geo.university/pages/blog?p=spectral-indices-with-multispectral-satellite-data
 
     '''
-   
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"])
-    index = abs((b8 * (1 - b4)*(b8 - b4)))**(1/3)
-    index = index / np.amax(index)
-    return index[0]
 
-def savi(dictionary):
+    return compute(dictionary, "avi", dtype)
+
+def savi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -260,6 +412,8 @@ def savi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -272,13 +426,9 @@ def savi(dictionary):
 
     '''
 
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"])
-    index = abs(((b8 - b4) / (b8 + b4 + 0.428))) * (1.428)
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "savi", dtype)
 
-def wsi(dictionary):
+def wsi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -298,6 +448,8 @@ def wsi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -310,13 +462,9 @@ def wsi(dictionary):
 
     '''
 
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b11 = dictionary["B11"] / np.amax(dictionary["B11"])
-    index = (b11/b8) * 1.25
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "wsi", dtype)
 
-def gci(dictionary):
+def gci(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -334,6 +482,8 @@ def gci(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -346,13 +496,9 @@ def gci(dictionary):
 
     '''
 
-    b9 = dictionary["B09"] / np.amax(dictionary["B09"])
-    b3 = dictionary["B03"] / np.amax(dictionary["B03"])
-    index = (b9 / b3) - 1
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "gci", dtype)
 
-def nbri(dictionary):
+def nbri(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -371,6 +517,8 @@ def nbri(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -383,13 +531,9 @@ def nbri(dictionary):
 
     '''
 
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b12 = dictionary["B12"] / np.amax(dictionary["B12"])
-    index = (b8 - b12) / (b8 + b12)
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "nbri", dtype)
 
-def bsi(dictionary):
+def bsi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -409,6 +553,8 @@ def bsi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -421,15 +567,9 @@ def bsi(dictionary):
 
     '''
 
-    b2 = dictionary["B02"] / np.amax(dictionary["B02"])
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"])
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    b11 = dictionary["B11"] / np.amax(dictionary["B11"])
-    index = ((b11 + b4) - (b8 + b2)) / ((b11 + b4) + (b8 + b2))
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "bsi", dtype)
 
-def ndwi(dictionary):
+def ndwi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -448,6 +588,8 @@ def ndwi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -460,13 +602,9 @@ def ndwi(dictionary):
 
     '''
 
-    b3 = dictionary["B03"] / np.amax(dictionary["B03"])
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"])
-    index = (b3 - b8) / (b3 + b8)
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "ndwi", dtype)
 
-def ndsi(dictionary):
+def ndsi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -486,6 +624,8 @@ def ndsi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -497,14 +637,10 @@ def ndsi(dictionary):
     https://www.bluemarblegeo.com/knowledgebase/global-mapper-19/Raster_Calculator.htm
 
     '''
- 
-    b3 = dictionary["B03"] / np.amax(dictionary["B03"])
-    b11 = dictionary["B11"] / np.amax(dictionary["B11"])
-    index = (b3 - b11) / (b3 + b11)
-    index = index / np.amax(index)
-    return index[0]
 
-def ndgi(dictionary):
+    return compute(dictionary, "ndsi", dtype)
+
+def ndgi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -521,6 +657,8 @@ def ndgi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -533,13 +671,9 @@ def ndgi(dictionary):
 
     '''
 
-    b3 = dictionary["B03"] / np.amax(dictionary["B03"])
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"])
-    index = (b3 - b4) / (b3 + b4)
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "ndgi", dtype)
 
-def arvi(dictionary):
+def arvi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -558,6 +692,8 @@ def arvi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -569,15 +705,10 @@ def arvi(dictionary):
     https://eos.com/blog/vegetation-indices/
 
     '''
- 
-    b2 = dictionary["B02"] / np.amax(dictionary["B02"]) # Blue
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"]) # Red
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"]) # NIR
-    index = (b8 - (2 * b4) + b2) / (b8 + (2 * b4) + b2)
-    index = index / np.amax(index)
-    return index[0]
 
-def sipi(dictionary):
+    return compute(dictionary, "arvi", dtype)
+
+def sipi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -594,6 +725,8 @@ def sipi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -606,14 +739,9 @@ def sipi(dictionary):
 
     '''
 
-    b2 = dictionary["B02"] / np.amax(dictionary["B02"]) # Blue
-    b4 = dictionary["B04"] / np.amax(dictionary["B04"]) # Red
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"]) # NIR
-    index = ((b8 - b2) / (b8 - b4)) * 1E+6
-    index = index / np.amax(index)
-    return index[0]
+    return compute(dictionary, "sipi", dtype)
 
-def bndi(dictionary):
+def bndi(dictionary, dtype="float32"):
     '''
     Description
     -----------
@@ -632,6 +760,8 @@ def bndi(dictionary):
     ----------- 
     dictionary: dict
         Dictionary that contains the bands.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
         
     Returns      
     -------
@@ -644,8 +774,4 @@ def bndi(dictionary):
 
     '''
 
-    b11 = dictionary["B11"] / np.amax(dictionary["B11"]) # SWIR
-    b8 = dictionary["B08"] / np.amax(dictionary["B08"]) # NIR
-    index = (b11 - b8) / (b11 + b8)
-    index = index / np.amax(index)
-    return index[0]
\ No newline at end of file
+    return compute(dictionary, "bndi", dtype)
\ No newline at end of file
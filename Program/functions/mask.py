@@ -0,0 +1,131 @@
+import os
+import numpy as np
+import rasterio as rs
+from rasterio.enums import Resampling
+from functions.tiling import read_window
+from functions import safe
+
+# Classes of the Scene Classification Layer (SCL) of the Level-2A products that are masked.
+SCL = {
+    0: "no data",
+    1: "saturated or defective",
+    3: "cloud shadows",
+    8: "cloud medium probability",
+    9: "cloud high probability",
+    10: "thin cirrus",
+}
+
+def find(path: str):
+    '''
+    Returns the full path of the SCL file of a scene folder, e.g. "T14QLG_20230101_SCL.tif", or
+    of a Level-2A .SAFE directory or .zip archive, or None if it has none.
+    '''
+    if safe.is_product(path):
+        return safe.files(path).get("SCL")
+    for file in sorted(os.listdir(path)):
+        if file.endswith(".tif") and "SCL" in file:
+            return os.path.join(path, file)
+    return None
+
+class Mask:
+    '''
+    Description
+    -----------
+    Mask of the pixels that must be left out of the computations, read from the SCL band of a
+    Level-2A scene or from a mask supplied by the user. It is read on the grid each band or index
+    is computed on, with nearest resampling so the classes are never mixed, and kept for every
+    grid it is asked for.
+
+    Parameters
+    -----------
+    file_path: str
+        Full path of the SCL file or of the user mask.
+    classes: iterable, optional
+        Values of the file that are masked. Default is the keys of SCL; None masks every
+        nonzero value, as in a user mask where 1 marks the invalid pixels.
+
+    Examples
+    --------
+    >>> images = read(1, 12, path, mask="scl")
+    >>> ndvi = indices.ndvi(images) # NaN over clouds, shadows and nodata
+    '''
+
+    def __init__(self, file_path: str, classes=tuple(SCL)):
+        self.file_path = file_path
+        self.classes = None if classes is None else tuple(sorted(classes))
+        self._grids = dict()
+
+    def __repr__(self):
+        return f"Mask({self.file_path!r}, classes={self.classes})"
+
+    def __getstate__(self):
+        # Los procesos del pool leen sus propias ventanas
+        state = dict(self.__dict__)
+        state["_grids"] = dict()
+        return state
+
+    def key(self):
+        '''
+        Returns a text that identifies the mask and its version, used by the cache.
+        '''
+        modified = os.stat(safe.local(self.file_path)).st_mtime_ns
+        return f"{os.path.abspath(self.file_path)}:{modified}:{self.classes}"
+
+    def invalid(self, values):
+        '''
+        Returns True where the values of the file are masked.
+        '''
+        if self.classes is None:
+            return values != 0
+        return np.isin(values, self.classes)
+
+    def read(self, shape: tuple):
+        '''
+        Returns the boolean mask of a whole grid, True where the pixels are masked.
+        '''
+        shape = tuple(shape)
+        if shape not in self._grids:
+            with rs.open(self.file_path) as src:
+                values = src.read(1, out_shape=shape, resampling=Resampling.nearest)
+            self._grids[shape] = self.invalid(values)
+        return self._grids[shape]
+
+    def open(self):
+        '''
+        Opens the file of the mask, for window().
+        '''
+        return rs.open(self.file_path)
+
+    def window(self, src, window, shape: tuple):
+        '''
+        Returns the boolean mask of a window of a grid, read from the dataset returned by open().
+        '''
+        return self.invalid(read_window(src, window, shape, Resampling.nearest))
+
+def create(path: str, mask):
+    '''
+    Description
+    -----------
+    Builds the mask of a scene from the value given to read() or to the command line.
+
+    Parameters
+    -----------
+    path: str
+        Folder of the scene.
+    mask: str, Mask or None
+        "scl" to use the SCL file of the folder, the full path of a user mask whose nonzero
+        pixels are masked, a Mask, or None for no mask.
+
+    Returns
+    -------
+    mask: Mask or None
+        The mask.
+    '''
+    if mask is None or isinstance(mask, Mask):
+        return mask
+    if mask == "scl":
+        file_path = find(path)
+        if file_path is None:
+            raise FileNotFoundError(f"There is no SCL file in {path}")
+        return Mask(file_path)
+    return Mask(mask, classes=None)
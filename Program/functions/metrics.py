@@ -0,0 +1,303 @@
+import os
+import json
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+# Prefix of the names of the Prometheus metrics.
+PREFIX = "sentinel2"
+
+# Recorder the stages and counters of the program go to, see enable().
+_active = None
+
+class Timer:
+    '''
+    Time in seconds spent inside a stage, set when the stage ends.
+    '''
+
+    def __init__(self):
+        self.seconds = 0.0
+
+class Recorder:
+    '''
+    Description
+    -----------
+    Collects the time spent in each stage of the program (open, decode, resample, normalize,
+    index, render, write...), the number of times each stage ran and counters such as the
+    bytes read and written. Optionally, it traces the memory allocated by numpy with tracemalloc
+    and keeps the peak of each stage, i.e. the most memory the arrays allocated inside the stage
+    held at once.
+
+    Stages can be nested; the time of a stage includes the time of the stages inside it.
+
+    tracemalloc keeps a single peak for the whole process, so the memory is only traced in the
+    stages of the main thread, which never run at the same time. The stages run by other
+    threads, e.g. the bands read at the same time by Bands.prefetch(), are timed with a peak
+    of 0, and what they allocate counts towards the stage of the main thread that waits for
+    them.
+
+    Parameters
+    -----------
+    memory: bool, optional
+        Whether to trace the memory of the arrays. It slows Python code down, but not the numpy
+        and GDAL operations. Default is False.
+    labels: str
+        Labels added to every record, e.g. scene="T14QLG_20230101".
+
+    Examples
+    --------
+    >>> recorder = metrics.enable(memory=True, scene="T14QLG_20230101")
+    >>> indices.ndvi(read(1, 12, path))
+    >>> metrics.disable()
+    >>> metrics.write([recorder], "metrics.prom")
+    '''
+
+    def __init__(self, memory=False, **labels):
+        self.memory = memory
+        self.labels = labels
+        self.stages = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Si tracemalloc fue iniciado por enable()
+        self._started = False
+
+    def __getstate__(self):
+        # Los procesos del planificador devuelven sus registros al proceso principal
+        state = dict(self.__dict__)
+        del state["_lock"], state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = list()
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Measures the code inside the with block as a run of the given stage.
+        '''
+        timer = Timer()
+        stack = self._stack()
+        # Un hilo que reiniciara el pico borraría el de las etapas de los demás
+        tracing = (self.memory and tracemalloc.is_tracing()
+                   and threading.current_thread() is threading.main_thread())
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # El pico de la etapa exterior se guarda antes de reiniciarlo
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+        else:
+            frame = [0, 0]
+        stack.append(frame)
+        t0 = perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.seconds = perf_counter() - t0
+            stack.pop()
+            peak = 0
+            if tracing:
+                frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+                peak = frame[1] - frame[0]
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], frame[1])
+            self.add(name, timer.seconds, peak)
+
+    def add(self, name: str, seconds: float, peak=0):
+        '''
+        Adds a run of a stage measured elsewhere.
+        '''
+        with self._lock:
+            record = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                   "peak_bytes": 0})
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["max_seconds"] = max(record["max_seconds"], seconds)
+            record["peak_bytes"] = max(record["peak_bytes"], peak)
+
+    def count(self, name: str, value=1):
+        '''
+        Increases a counter, e.g. count("bytes_read", band.nbytes).
+        '''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def records(self):
+        '''
+        Returns one dictionary per stage and per counter, with the labels of the recorder.
+        '''
+        records = [dict(self.labels, stage=name, seconds=round(record["seconds"], 6),
+                        max_seconds=round(record["max_seconds"], 6), calls=record["calls"],
+                        peak_bytes=record["peak_bytes"])
+                   for name, record in self.stages.items()]
+        records += [dict(self.labels, counter=name, value=value) for name, value in self.counters.items()]
+        return records
+
+def enable(memory=False, **labels):
+    '''
+    Description
+    -----------
+    Starts recording the stages of the program in a new Recorder, which replaces the previous
+    one. While no recorder is enabled, the stages are only timed and nothing is kept.
+
+    Parameters
+    -----------
+    memory: bool, optional
+        Whether to trace the memory of the arrays with tracemalloc. Default is False.
+    labels: str
+        Labels added to every record.
+
+    Returns
+    -------
+    recorder: Recorder
+        The enabled recorder.
+    '''
+    global _active
+    disable()
+    _active = Recorder(memory, **labels)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _active._started = True
+    return _active
+
+def disable():
+    '''
+    Stops recording and returns the recorder that was enabled, or None.
+    '''
+    global _active
+    recorder, _active = _active, None
+    if recorder is not None and recorder._started:
+        tracemalloc.stop()
+    return recorder
+
+@contextmanager
+def stage(name: str):
+    '''
+    Description
+    -----------
+    Measures the code inside the with block as a run of a stage of the enabled recorder. It
+    yields a Timer whose seconds are set when the block ends, also when no recorder is enabled.
+
+    Examples
+    --------
+    >>> with metrics.stage("decode") as decoding:
+    ...     band = src.read(1)
+    >>> decoding.seconds
+    '''
+    if _active is None:
+        timer = Timer()
+        t0 = perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.seconds = perf_counter() - t0
+    else:
+        with _active.stage(name) as timer:
+            yield timer
+
+def timed(name: str):
+    '''
+    Decorator that measures every call of a function as a run of a stage, see stage().
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name: str, value=1):
+    '''
+    Increases a counter of the enabled recorder, if any.
+    '''
+    if _active is not None:
+        _active.count(name, value)
+
+def prometheus(recorders):
+    '''
+    Description
+    -----------
+    Formats the records of several recorders in the Prometheus text exposition format, e.g. for
+    the textfile collector of the node exporter.
+
+    Parameters
+    -----------
+    recorders: list
+        Recorders to be formatted. Their labels tell their series apart.
+
+    Returns
+    -------
+    text: str
+        Content of the .prom file.
+    '''
+    metrics = {
+        "stage_seconds_total": ("counter", "Time spent in each stage.", "seconds"),
+        "stage_calls_total": ("counter", "Number of runs of each stage.", "calls"),
+        "stage_max_seconds": ("gauge", "Longest run of each stage.", "max_seconds"),
+        "stage_peak_bytes": ("gauge", "Peak memory of the arrays allocated in each stage.", "peak_bytes"),
+    }
+    lines = list()
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def series(labels):
+        text = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+        return "{" + text + "}" if text else ""
+
+    for metric, (kind, description, field) in metrics.items():
+        lines += [f"# HELP {PREFIX}_{metric} {description}", f"# TYPE {PREFIX}_{metric} {kind}"]
+        for recorder in recorders:
+            for name, record in recorder.stages.items():
+                lines.append(f"{PREFIX}_{metric}{series(dict(recorder.labels, stage=name))} {record[field]}")
+    counters = sorted({name for recorder in recorders for name in recorder.counters})
+    for name in counters:
+        lines += [f"# HELP {PREFIX}_{name}_total Counter {name}.", f"# TYPE {PREFIX}_{name}_total counter"]
+        for recorder in recorders:
+            if name in recorder.counters:
+                lines.append(f"{PREFIX}_{name}_total{series(recorder.labels)} {recorder.counters[name]}")
+    return "\n".join(lines) + "\n"
+
+def write(recorders, out_path: str):
+    '''
+    Description
+    -----------
+    Writes the records of several recorders to a file. Files ending with .prom are replaced by
+    the Prometheus text of all the recorders, written to a temporary file first so a collector
+    never reads a partial file; any other file gets one JSON line per record appended.
+
+    Parameters
+    -----------
+    recorders: list
+        Recorders to be written.
+    out_path: str
+        Full path of the .prom or JSON lines file.
+
+    Returns
+    -------
+    out_path: str
+        Full path of the written file.
+    '''
+    if out_path.endswith(".prom"):
+        temporary = f"{out_path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(prometheus(recorders))
+        os.replace(temporary, out_path)
+    else:
+        with open(out_path, "a") as file:
+            for recorder in recorders:
+                for record in recorder.records():
+                    file.write(json.dumps(record) + "\n")
+    return out_path
@@ -0,0 +1,217 @@
+from contextlib import nullcontext
+import numpy as np
+import rasterio as rs
+
+# Number of bins of the histograms. The 16-bit bands of Sentinel-2 fit in it with one bin per
+# value, so their percentiles are exact.
+BINS = 65536
+
+# Percentile used as the maximum by the "percentile" stretch.
+PERCENTILE = 99.0
+
+# Ways of normalizing a band or an index: dividing it by its maximum, or by a high percentile
+# and clipping it to 1, so a few saturated or hot pixels do not compress the whole range.
+STRETCHES = ("max", "percentile")
+
+class Statistics:
+    '''
+    Description
+    -----------
+    Global statistics of an array gathered block by block in one streaming pass: count,
+    minimum, maximum and a histogram from which any percentile can be taken. NaN and infinite
+    values are ignored, so masked pixels and divisions by zero do not affect them.
+
+    The histogram starts on the range of the first block and, when a later block falls outside
+    it, the width of its bins is doubled and the range extended until the block fits, so the
+    memory used is always that of the bins. For integer data the bins start one value wide,
+    which keeps the percentiles of 16-bit data exact; for float data a percentile is off by at
+    most the width of a bin.
+
+    Parameters
+    -----------
+    bins: int, optional
+        Number of bins of the histogram. It must be even. Default is BINS; None only keeps the
+        count, the minimum and the maximum, which is all the "max" stretch needs.
+
+    Examples
+    --------
+    >>> statistics = Statistics()
+    >>> for _, window in src.block_windows(1):
+    ...     statistics.update(src.read(1, window=window))
+    >>> statistics.maximum, statistics.percentile(99)
+    '''
+
+    def __init__(self, bins=BINS):
+        self.bins = bins
+        self.count = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.integer = True
+        self.histogram = None
+        self.low = 0.0
+        self.width = 1.0
+
+    def __repr__(self):
+        return f"Statistics(count={self.count}, minimum={self.minimum}, maximum={self.maximum})"
+
+    def update(self, block):
+        '''
+        Adds the values of a block and returns the statistics.
+        '''
+        values = np.asarray(block).reshape(-1)
+        self.integer = self.integer and values.dtype.kind in "biu"
+        if values.dtype.kind == "f":
+            values = values[np.isfinite(values)]
+        if values.size == 0:
+            return self
+        low, high = values.min(), values.max()
+        self.count += values.size
+        self.minimum = min(self.minimum, low.item())
+        self.maximum = max(self.maximum, high.item())
+        if self.bins is None:
+            return self
+        if self.histogram is None:
+            self._start(float(low), float(high))
+        self._extend(float(low), float(high))
+        self.histogram += np.bincount(self._index(values), minlength=self.bins)
+        return self
+
+    def _start(self, low: float, high: float):
+        self.low = low
+        if self.integer:
+            self.width = float(max(1, -(-(high - low + 1) // self.bins)))
+        else:
+            self.width = (high - low) / self.bins or max(abs(low), 1.0) * 1e-7
+        self.histogram = np.zeros(self.bins, dtype="int64")
+
+    def _extend(self, low: float, high: float):
+        # Duplica el ancho de los bins hasta que el rango contiene al bloque; un valor entero
+        # igual al límite superior ya no cabe en el último bin
+        while (low < self.low or high > self.low + self.bins * self.width
+               or (self.integer and high == self.low + self.bins * self.width)):
+            merged = self.histogram.reshape(-1, 2).sum(axis=1)
+            self.histogram = np.zeros(self.bins, dtype="int64")
+            if low < self.low:
+                self.low -= self.bins * self.width
+                self.histogram[self.bins // 2:] = merged
+            else:
+                self.histogram[:self.bins // 2] = merged
+            self.width *= 2
+
+    def _index(self, values):
+        index = ((values - self.low) / self.width).astype("int64")
+        return np.clip(index, 0, self.bins - 1)
+
+    def percentile(self, q: float):
+        '''
+        Description
+        -----------
+        Returns a percentile of the values, interpolated inside its bin for float data.
+
+        Parameters
+        -----------
+        q: float
+            Percentile between 0 and 100.
+
+        Returns
+        -------
+        value: float
+            Value below which q percent of the values lie.
+        '''
+        if self.count == 0:
+            return np.nan
+        if self.bins is None and 0 < q < 100:
+            raise ValueError("These statistics were gathered without a histogram (bins=None)")
+        if q >= 100:
+            return self.maximum
+        if q <= 0:
+            return self.minimum
+        cumulative = np.cumsum(self.histogram)
+        rank = q / 100 * self.count
+        i = int(np.searchsorted(cumulative, rank))
+        if self.integer:
+            value = self.low + i * self.width
+        else:
+            before = cumulative[i - 1] if i else 0
+            value = self.low + (i + (rank - before) / self.histogram[i]) * self.width
+        return float(min(max(value, self.minimum), self.maximum))
+
+    def divisor(self, stretch="max", percentile=PERCENTILE):
+        '''
+        Returns the value the array is divided by to be normalized with the given stretch.
+        '''
+        if stretch not in STRETCHES:
+            raise ValueError(f"Unknown stretch {stretch!r}, use one of {STRETCHES}")
+        return self.maximum if stretch == "max" else self.percentile(percentile)
+
+def bins_for(stretch="max"):
+    '''
+    Returns the number of bins the statistics of a stretch need: none for "max".
+    '''
+    if stretch not in STRETCHES:
+        raise ValueError(f"Unknown stretch {stretch!r}, use one of {STRETCHES}")
+    return None if stretch == "max" else BINS
+
+def statistics(file_path: str, bins=BINS, mask=None):
+    '''
+    Description
+    -----------
+    Gathers the statistics of a band block by block at its native resolution, so the band is
+    never loaded whole in memory.
+
+    Parameters
+    -----------
+    file_path: str
+        Full path of the band file.
+    bins: int, optional
+        Number of bins of the histogram, or None to only gather the maximum and the minimum.
+        Default is BINS.
+    mask: Mask, optional
+        Pixels left out of the statistics, see functions/mask.py. Default is None.
+
+    Returns
+    -------
+    statistics: Statistics
+        Statistics of the first band of the file.
+    '''
+    result = Statistics(bins)
+    with rs.open(file_path) as src, (nullcontext() if mask is None else mask.open()) as masking:
+        shape = (src.height, src.width)
+        for _, window in src.block_windows(1):
+            block = src.read(1, window=window)
+            if mask is not None:
+                block = block[~mask.window(masking, window, shape)]
+            result.update(block)
+    return result
+
+def apply(array, divisor: float, stretch="max", out=None):
+    '''
+    Description
+    -----------
+    Normalizes an array, or a block of it, with a divisor computed in a previous pass. With the
+    "percentile" stretch, the values above the percentile are clipped to 1.
+
+    Parameters
+    -----------
+    array: ndarray
+        Array or block to be normalized.
+    divisor: float
+        Value returned by Statistics.divisor().
+    stretch: str, optional
+        "max" or "percentile". Default is "max".
+    out: ndarray, optional
+        Array where the result is written, e.g. the array itself. Default is None, which
+        allocates it.
+
+    Returns
+    -------
+    array: ndarray
+        Normalized array.
+    '''
+    if divisor == 0:
+        # Un arreglo cuyo máximo es cero no se puede normalizar; queda como nodata sin avisos
+        divisor = np.nan
+    out = np.divide(array, divisor, out=out)
+    if stretch == "percentile":
+        np.minimum(out, 1, out=out)
+    return out
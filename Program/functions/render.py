@@ -0,0 +1,188 @@
+import os
+import zlib
+import struct
+from functools import lru_cache
+import numpy as np
+import matplotlib
+from functions import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Largest side in pixels of the quicklooks.
+QUICKLOOK = 2048
+
+@lru_cache(maxsize=None)
+def lut(cmap="viridis"):
+    '''
+    Description
+    -----------
+    Returns a 256-entry lookup table of a matplotlib colormap. Only the colors of the colormap
+    are taken from matplotlib; the images are never drawn by it.
+
+    Parameters
+    -----------
+    cmap: str, optional
+        Name of the matplotlib colormap. Default is "viridis".
+
+    Returns
+    -------
+    lut: ndarray
+        Array of shape (256, 3) and type uint8.
+    '''
+    colors = matplotlib.colormaps[cmap](np.linspace(0, 1, 256))[:, :3]
+    return np.round(colors * 255).astype("uint8")
+
+def decimate(array, size=QUICKLOOK):
+    '''
+    Returns a view of an image with one out of every n pixels, so its largest side is at most
+    size. No pixel is copied.
+    '''
+    step = max(1, -(-max(array.shape[:2]) // size))
+    return array[::step, ::step]
+
+@metrics.timed("render")
+def colorize(array, cmap="viridis", size=QUICKLOOK, colorbar=True):
+    '''
+    Description
+    -----------
+    Renders an index as an RGB image: the decimated values are stretched between their minimum
+    and maximum to 0-255 and mapped through the lookup table of the colormap. Optionally, a
+    vertical colorbar strip is drawn on the right side of the image.
+
+    Parameters
+    -----------
+    array: ndarray
+        2D array containing the values of the index.
+    cmap: str, optional
+        Name of the matplotlib colormap. Default is "viridis".
+    size: int, optional
+        Largest side in pixels of the image. Default is QUICKLOOK.
+    colorbar: bool, optional
+        Whether to draw the colorbar strip. Default is True.
+
+    Returns
+    -------
+    image: ndarray
+        Array of shape (height, width, 3) and type uint8. NaN values are drawn black.
+    '''
+    values = np.asarray(decimate(array, size), dtype="float32")
+    valid = np.isfinite(values)
+    low, high = (np.amin(values[valid]), np.amax(values[valid])) if valid.any() else (0, 1)
+    scale = 255 / (high - low) if high > low else 0
+    levels = np.zeros(values.shape, dtype="uint8")
+    levels[valid] = np.clip((values[valid] - low) * scale, 0, 255).astype("uint8")
+    image = lut(cmap)[levels]
+    image[~valid] = 0
+    if not colorbar:
+        return image
+    height = image.shape[0]
+    width = max(4, height // 25)
+    gradient = np.linspace(255, 0, height).astype("uint8")
+    strip = np.broadcast_to(lut(cmap)[gradient][:, None, :], (height, width, 3))
+    gap = np.full((height, width // 2, 3), 255, dtype="uint8")
+    return np.concatenate([image, gap, strip], axis=1)
+
+@metrics.timed("render")
+def composite(array, size=QUICKLOOK, stretch=False):
+    '''
+    Description
+    -----------
+    Renders a composite as an RGB image. The decimated composite is converted to uint8 once,
+    clipping it to 0-1 as matplotlib does, so the brightness factor of the composite is kept.
+    Optionally, each channel is then stretched between its minimum and maximum with integer
+    arithmetic.
+
+    Parameters
+    -----------
+    array: ndarray
+        Array of shape (height, width, 3), either uint8 or float with values around 0-1.
+    size: int, optional
+        Largest side in pixels of the image. Default is QUICKLOOK.
+    stretch: bool, optional
+        Whether to stretch each channel to 0-255. Default is False.
+
+    Returns
+    -------
+    image: ndarray
+        Array of shape (height, width, 3) and type uint8.
+    '''
+    image = decimate(array, size)
+    if image.dtype != np.uint8:
+        image = np.clip(np.nan_to_num(image) * 255, 0, 255).astype("uint8")
+    if not stretch:
+        return np.ascontiguousarray(image)
+    image = image.astype("uint16")
+    for channel in range(image.shape[2]):
+        band = image[..., channel]
+        low, high = int(band.min()), int(band.max())
+        if high > low:
+            band -= low
+            band *= 255
+            band //= high - low
+    return image.astype("uint8")
+
+def encode_png(image):
+    '''
+    Description
+    -----------
+    Encodes an RGB uint8 image as PNG with zlib, without any imaging library.
+
+    Parameters
+    -----------
+    image: ndarray
+        Array of shape (height, width, 3) and type uint8.
+
+    Returns
+    -------
+    png: bytes
+        Content of the PNG file.
+    '''
+    height, width = image.shape[:2]
+    # Cada fila empieza con el byte del filtro (0, sin filtro)
+    rows = np.zeros((height, width * 3 + 1), dtype="uint8")
+    rows[:, 1:] = np.ascontiguousarray(image).reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)) + chunk(b"IEND", b""))
+
+def save(image, out_path: str, quality=90):
+    '''
+    Description
+    -----------
+    Saves an RGB uint8 image as PNG or JPEG, depending on the extension of the path. JPEG needs
+    Pillow; PNG uses Pillow when it is installed and the built-in encoder otherwise.
+
+    Parameters
+    -----------
+    image: ndarray
+        Array of shape (height, width, 3) and type uint8.
+    out_path: str
+        Full path of the image, ending with .png, .jpg or .jpeg.
+    quality: int, optional
+        Quality of the JPEG images. Default is 90.
+
+    Returns
+    -------
+    out_path: str
+        Full path of the saved image.
+    '''
+    extension = os.path.splitext(out_path)[1].lower()
+    if extension in (".jpg", ".jpeg") and Image is None:
+        raise ImportError("Saving JPEG quicklooks requires Pillow: pip install pillow")
+    with metrics.stage("write"):
+        if extension in (".jpg", ".jpeg"):
+            Image.fromarray(np.ascontiguousarray(image)).save(out_path, quality=quality)
+        elif Image is not None:
+            Image.fromarray(np.ascontiguousarray(image)).save(out_path)
+        else:
+            with open(out_path, "wb") as file:
+                file.write(encode_png(image))
+    metrics.count("bytes_written", os.path.getsize(out_path))
+    return out_path
@@ -0,0 +1,122 @@
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+# Band or SCL file inside IMG_DATA, e.g. "T14QLG_20230101T170000_B02.jp2" in Level-1C products
+# and "T14QLG_20230101T170000_B02_10m.jp2" in Level-2A ones, which keep each band at 10, 20
+# and 60 m in the R10m, R20m and R60m folders.
+IMAGE = re.compile(r"_(B\d[\dA]|SCL)(?:_(\d+)m)?\.jp2$", re.IGNORECASE)
+
+def is_product(path: str):
+    '''
+    Returns True if the path is a Sentinel-2 product as downloaded, a .SAFE directory or a .zip
+    archive, instead of a folder of .tif bands.
+    '''
+    path = os.path.normpath(path)
+    if path.upper().endswith(".SAFE"):
+        return os.path.isdir(path)
+    return path.lower().endswith(".zip") and zipfile.is_zipfile(path)
+
+def name(path: str):
+    '''
+    Returns the name of a scene folder or product, without the .SAFE or .zip extension.
+    '''
+    base = os.path.basename(os.path.normpath(path))
+    stem, extension = os.path.splitext(base)
+    return stem if extension.upper() in (".SAFE", ".ZIP") else base
+
+def local(file_path: str):
+    '''
+    Returns the file on disk that holds a band: the path itself, or the archive of a band opened
+    through /vsizip/, e.g. "/vsizip//data/S2A_MSIL2A.zip/S2A_MSIL2A.SAFE/..." -> "/data/S2A_MSIL2A.zip".
+    '''
+    if not file_path.startswith("/vsizip/"):
+        return file_path
+    inner = file_path[len("/vsizip/"):]
+    end = inner.lower().find(".zip") + len(".zip")
+    return inner[:end]
+
+def _manifest(text):
+    # Rutas relativas de las imágenes listadas en el manifest.safe
+    hrefs = list()
+    for element in ET.fromstring(text).iter():
+        if element.tag.split("}")[-1] == "fileLocation":
+            href = element.get("href", "")
+            if "IMG_DATA" in href and href.lower().endswith(".jp2"):
+                hrefs.append(os.path.normpath(href).replace(os.sep, "/"))
+    return hrefs
+
+def _members(path: str):
+    # (prefijo para abrir con rasterio, rutas relativas de las imágenes)
+    if os.path.isdir(path):
+        prefix = os.path.abspath(path)
+        manifest = os.path.join(path, "manifest.safe")
+        if os.path.exists(manifest):
+            with open(manifest, "rb") as file:
+                hrefs = _manifest(file.read())
+            if hrefs:
+                return prefix, hrefs
+        hrefs = list()
+        for root, _, files in os.walk(path):
+            hrefs += [os.path.relpath(os.path.join(root, file), path).replace(os.sep, "/")
+                      for file in files if file.lower().endswith(".jp2")]
+        return prefix, [href for href in hrefs if "IMG_DATA" in href]
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        manifests = sorted((name for name in names if name.endswith("manifest.safe")), key=len)
+        folder = os.path.dirname(manifests[0]) if manifests else ""
+        hrefs = _manifest(archive.read(manifests[0])) if manifests else list()
+    prefix = f"/vsizip/{os.path.abspath(path)}"
+    if folder:
+        prefix = f"{prefix}/{folder}"
+    if not hrefs:
+        hrefs = [name[len(folder):].lstrip("/") for name in names
+                 if "IMG_DATA" in name and name.lower().endswith(".jp2")]
+    return prefix, hrefs
+
+def files(path: str, native=None):
+    '''
+    Description
+    -----------
+    Finds the bands of a Sentinel-2 .SAFE directory or .zip archive from the list of files of
+    its manifest.safe (or, if it has none, from the IMG_DATA folders), so they are read from the
+    original JP2 files, through GDAL's /vsizip/ for archives, without converting them to TIF.
+    In Level-2A products a band can be in several resolution folders, e.g. B01 is in R60m and,
+    resampled from it, in R20m; the one at its native resolution is taken.
+
+    Parameters
+    -----------
+    path: str
+        Full path of the .SAFE directory or of the .zip archive.
+    native: dict, optional
+        Native resolution in meters of each band code, e.g. bands.RESOLUTIONS. A band is taken
+        from the folder of its native resolution, or, if it is not in native or not in that
+        folder, from the finest one. Default is None, which always takes the finest one.
+
+    Returns
+    -------
+    files: dict
+        Dictionary that maps each band code, and "SCL" in Level-2A products, to the path of its
+        file, as given to rasterio.open().
+    '''
+    prefix, hrefs = _members(path)
+    found = dict()
+    for href in sorted(hrefs):
+        match = IMAGE.search(href)
+        if match is None:
+            continue
+        code = match.group(1).upper()
+        resolution = int(match.group(2) or 0)
+        # Primero la carpeta de la resolución nativa, después la más fina
+        rank = (resolution != (native or dict()).get(code), resolution)
+        if code not in found or rank < found[code][0]:
+            found[code] = (rank, f"{prefix}/{href}")
+    return {code: file for code, (_, file) in found.items()}
+
+def folder(path: str):
+    '''
+    Returns the folder where the products of a scene are saved by default: the scene folder or
+    .SAFE directory itself, or the folder that holds a .zip archive.
+    '''
+    return os.path.dirname(os.path.abspath(path)) if os.path.isfile(path) else path
@@ -0,0 +1,210 @@
+import os
+import sys
+import glob
+import time
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functions import safe
+
+def is_scene(path: str):
+    '''
+    Returns True if the path is a folder of .tif bands, a .SAFE directory or a .zip product.
+    '''
+    return os.path.isdir(path) or safe.is_product(path)
+
+def expand(patterns, manifest=None):
+    '''
+    Description
+    -----------
+    Lists the scene folders, .SAFE directories and .zip products given as paths or glob
+    patterns, e.g. "/data/S2*_MSIL2A_2023*.zip", and in a
+    manifest file with one folder per line (empty lines and lines starting with # are skipped).
+    Each folder appears once, in the order given. Paths that are not glob patterns are kept even
+    if they are not a scene, so run() reports them as failed instead of leaving them out.
+
+    Parameters
+    -----------
+    patterns: list
+        Paths or glob patterns of the scene folders.
+    manifest: str, optional
+        Full path of the manifest file. Default is None.
+
+    Returns
+    -------
+    scenes: list
+        Full paths of the scene folders.
+    '''
+    patterns = list(patterns)
+    if manifest is not None:
+        with open(manifest) as file:
+            patterns += [line.strip() for line in file if line.strip() and not line.strip().startswith("#")]
+    scenes = list()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = [scene for scene in sorted(glob.glob(pattern)) if is_scene(scene)]
+        else:
+            matches = [pattern]
+        for scene in matches:
+            scene = os.path.abspath(scene)
+            if scene not in scenes:
+                scenes.append(scene)
+    return scenes
+
+class State:
+    '''
+    Description
+    -----------
+    SQLite file that records the status of every product of every scene ("running", "done" or
+    "failed") and the path of its output, so a run that crashes or is killed can be started
+    again and only the products that did not finish are computed.
+
+    Parameters
+    -----------
+    path: str, optional
+        Full path of the state file. Default is ":memory:", which keeps nothing between runs.
+
+    Examples
+    --------
+    >>> state = State("jobs.sqlite")
+    >>> state.pending("/data/T14QLG_20230101", ["index/ndvi", "index/ndmi"])
+    ['index/ndmi']
+    '''
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS products (scene TEXT, product TEXT, status TEXT, "
+                                    "output TEXT, error TEXT, updated REAL, PRIMARY KEY (scene, product))")
+
+    def close(self):
+        self.connection.close()
+
+    def _set(self, scene: str, product: str, status: str, output=None, error=None):
+        self.connection.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)",
+                                (scene, product, status, output, error, time.time()))
+
+    def pending(self, scene: str, products):
+        '''
+        Returns the products of a scene that are not done, or whose output no longer exists.
+        '''
+        rows = self.connection.execute("SELECT product, output FROM products WHERE scene = ? AND status = 'done'",
+                                       (scene,)).fetchall()
+        finished = {product for product, output in rows if output and os.path.exists(output)}
+        return [product for product in products if product not in finished]
+
+    def start(self, scene: str, products):
+        '''
+        Marks products of a scene as running.
+        '''
+        with self.connection:
+            for product in products:
+                self._set(scene, product, "running")
+
+    def finish(self, scene: str, outputs: dict):
+        '''
+        Marks products of a scene as done, given the path of the output of each one. Any other
+        product recorded as done with the same output, e.g. the same index written before with
+        other options, is forgotten, since its file was just overwritten.
+        '''
+        with self.connection:
+            for product, output in outputs.items():
+                output = os.path.abspath(output)
+                self.connection.execute("DELETE FROM products WHERE output = ? AND NOT (scene = ? AND product = ?)",
+                                        (output, scene, product))
+                self._set(scene, product, "done", output)
+
+    def fail(self, scene: str, products, error: str):
+        '''
+        Marks products of a scene as failed with the error raised.
+        '''
+        with self.connection:
+            for product in products:
+                self._set(scene, product, "failed", error=error)
+
+def run(scenes, products, function, state=None, jobs=1, callback=None):
+    '''
+    Description
+    -----------
+    Computes the products of many scenes, up to jobs scenes at a time, skipping the products
+    that the state records as done. The state is updated in this process as each scene
+    finishes, so it is never written by two processes at once and a killed run loses at most
+    the scenes that were in progress.
+
+    Parameters
+    -----------
+    scenes: list
+        Full paths of the scene folders, see expand(). Paths that are not a scene fail without
+        calling function.
+    products: list
+        Names of the products, e.g. ["composite/natural", "index/ndvi"].
+    function: callable
+        function(scene, products) computes the given products of a scene and returns a tuple
+        (outputs, extra): a dictionary that maps each product to the full path of its output,
+        and any picklable value that is passed to callback. With more than one job it must be
+        defined at module level, so it can be sent to the processes of the pool.
+    state: State, optional
+        State of the products. Default is None, which uses a state kept in memory.
+    jobs: int, optional
+        Number of scenes processed at the same time, each in its own process. Default is 1,
+        which processes them one after another in the current process.
+    callback: callable, optional
+        callback(scene, extra) is called in this process after each scene that succeeds.
+
+    Returns
+    -------
+    failed: list
+        Scenes that failed.
+    '''
+    state = state or State()
+    failed = list()
+
+    def finished(scene, pending, result=None, error=None):
+        if error is None:
+            outputs, extra = result
+            state.finish(scene, outputs)
+            print(f"{scene}: {len(outputs)} files written")
+            if callback is not None:
+                callback(scene, extra)
+        else:
+            failed.append(scene)
+            text = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+            state.fail(scene, pending, text)
+            print(text, end="", file=sys.stderr)
+            print(f"{scene}: failed", file=sys.stderr)
+
+    tasks = list()
+    for scene in scenes:
+        pending = state.pending(scene, products)
+        if not pending:
+            print(f"{scene}: already done")
+        elif not is_scene(scene):
+            finished(scene, pending, error=FileNotFoundError(f"{scene} is not a scene folder, .SAFE directory "
+                                                             "or .zip product"))
+        else:
+            tasks.append((scene, pending))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = dict()
+            for scene, pending in tasks:
+                state.start(scene, pending)
+                futures[pool.submit(function, scene, pending)] = (scene, pending)
+            for future in as_completed(futures):
+                scene, pending = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    finished(scene, pending, error=error)
+                else:
+                    finished(scene, pending, result)
+    else:
+        for scene, pending in tasks:
+            state.start(scene, pending)
+            try:
+                result = function(scene, pending)
+            except Exception as error:
+                finished(scene, pending, error=error)
+            else:
+                finished(scene, pending, result)
+    return failed
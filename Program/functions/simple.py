@@ -1,7 +1,12 @@
+import os
 import matplotlib.pyplot as plt
 import numpy as np
+from functions.bands import on_grid
+from functions import render
+from functions import metrics
+from functions.expression import CHUNK
 
-def create(array: any, title: str, save=False, path=None):
+def create(array: any, title: str, save=False, path=None, display=None):
     '''
     Display the image in a matplotlib subplot.
 
@@ -16,6 +21,11 @@ def create(array: any, title: str, save=False, path=None):
     path: str
         Path where the folder "Compositions" will be created.
         Default is the same path where the images are saved.
+    display: bool, optional
+        Whether to display the saved image. Default is None, which asks the user for it.
+        With False, nothing is displayed nor asked, so it can be used without a screen, and the
+        saved image is a quicklook rendered by functions/render.py instead of a matplotlib figure:
+        it is much faster and lighter, but has no title.
 
     Notes
     -----
@@ -30,18 +40,84 @@ def create(array: any, title: str, save=False, path=None):
     >>> simple.create(image, 'NDVI', cmap='viridis')
     '''
 
+    if save == True and path != None and display is False:
+        # Sin pantalla: vista rápida sin pasar por matplotlib
+        os.makedirs(os.path.join(path, "Compositions"), exist_ok=True)
+        render.save(render.composite(array), os.path.join(path, "Compositions", f"{title}.png"))
+        return
     plt.imshow(array)
     plt.title(title)
     plt.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
     if save == True and path != None:
-        plt.savefig(f"{path}\Compositions\{title}.png", dpi=400)
-        display = input("Display image? (Y/N): ")
-        if display == 'Y' or display == 'Y'.lower():
+        os.makedirs(os.path.join(path, "Compositions"), exist_ok=True)
+        plt.savefig(os.path.join(path, "Compositions", f"{title}.png"), dpi=400)
+        if display is None:
+            display = input("Display image? (Y/N): ") in ("Y", "y")
+        if display:
             plt.show()
+        else:
+            plt.close()
+    elif display is False:
+        plt.close()
     else: 
         plt.show()
 
-def natural_color(dictionary, alpha=1.5):
+def build(dictionary, codes, alpha=1.5, dtype="float32", output="uint8", out=None):
+    '''
+    Description
+    -----------
+    Builds a composite of three bands straight into one interleaved (height, width, 3) array,
+    a block of rows at a time: each channel of the block is scaled by the brightness factor and
+    clipped in a small reusable buffer and written into its place in the output, so no
+    full-size temporary is created besides the composite itself.
+
+    Parameters 
+    ----------- 
+    dictionary: dict
+        Dictionary that contains the bands.
+    codes: tuple
+        Codes of the bands of the red, green and blue channels, e.g. ("B04", "B03", "B02").
+    alpha: float, optional
+        Parameter that changes the brightness of the image. Default is 1.5.
+    dtype: str, optional
+        Floating point data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255 and NaN drawn black, or a
+        float type, with values from 0 to 1 and NaN kept. Default is "uint8".
+    out: ndarray, optional
+        Array of shape (height, width, 3) where the composite is written; its data type is used
+        instead of output. Default is None, which allocates it.
+
+    Returns      
+    -------
+    rgb: ndarray
+        Array containing the composite.
+    '''
+    dictionary = on_grid(dictionary, codes, prefetch=True)
+    channels = [np.asarray(dictionary[code]) for code in codes]
+    height, width = channels[0].shape[-2:]
+    if out is None:
+        out = np.empty((height, width, len(codes)), output)
+    output = out.dtype
+    rows = max(1, CHUNK // width)
+    buffer = np.empty((min(rows, height), width), dtype)
+    with metrics.stage("composite"):
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            scratch = buffer[:stop - start]
+            for channel, band in enumerate(channels):
+                np.multiply(band.reshape(height, width)[start:stop], alpha, out=scratch)
+                if output.kind == "f":
+                    np.clip(scratch, 0, 1, out=scratch)
+                else:
+                    # Misma conversión que render.composite(), los NaN quedan en negro
+                    np.multiply(scratch, 255, out=scratch)
+                    np.nan_to_num(scratch, copy=False)
+                    np.clip(scratch, 0, 255, out=scratch)
+                out[start:stop, :, channel] = scratch
+    return out
+
+def natural_color(dictionary, alpha=1.5, dtype="float32", output="uint8"):
     '''
     Description
     -----------
@@ -63,6 +139,11 @@ def natural_color(dictionary, alpha=1.5):
     alpha: float, optional
         Parameter that changes the brightness of the image. Lower is darker, higher is brighter.
         Default is 1.5.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255, or a float type, with
+        values from 0 to 1. Default is "uint8".
         
     Returns      
     -------
@@ -78,10 +159,9 @@ def natural_color(dictionary, alpha=1.5):
 
     '''
     
-    rgb = np.stack([dictionary["B04"], dictionary["B03"], dictionary["B02"]], axis=-1)
-    return rgb[0]*alpha
+    return build(dictionary, ("B04", "B03", "B02"), alpha, dtype, output)
 
-def infrared(dictionary, alpha=1.5):
+def infrared(dictionary, alpha=1.5, dtype="float32", output="uint8"):
     '''
     Description
     -----------
@@ -101,6 +181,11 @@ def infrared(dictionary, alpha=1.5):
     alpha: float, optional
         Parameter that changes the brightness of the image. Lower is darker, higher is brighter.
         Default is 1.5.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255, or a float type, with
+        values from 0 to 1. Default is "uint8".
         
     Returns      
     -------
@@ -112,10 +197,9 @@ def infrared(dictionary, alpha=1.5):
     https://gisgeography.com/sentinel-2-bands-combinations/
     '''
 
-    ir = np.stack([dictionary["B08"], dictionary["B04"], dictionary["B03"]], axis=-1)
-    return ir[0]*alpha
+    return build(dictionary, ("B08", "B04", "B03"), alpha, dtype, output)
 
-def shortwave_ir(dictionary, alpha=1.5):
+def shortwave_ir(dictionary, alpha=1.5, dtype="float32", output="uint8"):
     '''
     Description
     -----------
@@ -135,6 +219,11 @@ def shortwave_ir(dictionary, alpha=1.5):
     alpha: float, optional
         Parameter that changes the brightness of the image. Lower is darker, higher is brighter.
         Default is 1.5.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255, or a float type, with
+        values from 0 to 1. Default is "uint8".
         
     Returns      
     -------
@@ -146,10 +235,9 @@ def shortwave_ir(dictionary, alpha=1.5):
     https://gisgeography.com/sentinel-2-bands-combinations/
     '''
     
-    swir = np.stack([dictionary["B12"], dictionary["B8A"], dictionary["B04"]], axis=-1)
-    return swir[0]*alpha
+    return build(dictionary, ("B12", "B8A", "B04"), alpha, dtype, output)
 
-def agriculture(dictionary, alpha=1.5):
+def agriculture(dictionary, alpha=1.5, dtype="float32", output="uint8"):
     '''
     Description
     -----------
@@ -170,6 +258,11 @@ def agriculture(dictionary, alpha=1.5):
     alpha: float, optional
         Parameter that changes the brightness of the image. Lower is darker, higher is brighter.
         Default is 1.5.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255, or a float type, with
+        values from 0 to 1. Default is "uint8".
         
     Returns      
     -------
@@ -181,10 +274,9 @@ def agriculture(dictionary, alpha=1.5):
     https://gisgeography.com/sentinel-2-bands-combinations/
     '''
 
-    agr = np.stack([dictionary["B11"], dictionary["B08"], dictionary["B02"]], axis=-1)
-    return agr[0]*alpha
+    return build(dictionary, ("B11", "B08", "B02"), alpha, dtype, output)
 
-def geology(dictionary, alpha=1.5):
+def geology(dictionary, alpha=1.5, dtype="float32", output="uint8"):
     '''
     Description
     -----------
@@ -205,6 +297,11 @@ def geology(dictionary, alpha=1.5):
     alpha: float, optional
         Parameter that changes the brightness of the image. Lower is darker, higher is brighter.
         Default is 1.5.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255, or a float type, with
+        values from 0 to 1. Default is "uint8".
         
     Returns      
     -------
@@ -215,10 +312,9 @@ def geology(dictionary, alpha=1.5):
     ----------
     https://gisgeography.com/sentinel-2-bands-combinations/
     '''
-    geo = np.stack([dictionary["B12"], dictionary["B11"], dictionary["B02"]], axis=-1)
-    return geo[0]*alpha
+    return build(dictionary, ("B12", "B11", "B02"), alpha, dtype, output)
 
-def bathymetric(dictionary, alpha=1.5):
+def bathymetric(dictionary, alpha=1.5, dtype="float32", output="uint8"):
     '''
     Description
     -----------
@@ -233,6 +329,11 @@ def bathymetric(dictionary, alpha=1.5):
     alpha: float, optional
         Parameter that changes the brightness of the image. Lower is darker, higher is brighter.
         Default is 1.5.
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    output: str, optional
+        Data type of the composite: "uint8", with values from 0 to 255, or a float type, with
+        values from 0 to 1. Default is "uint8".
     
     Formula
     -------
@@ -245,5 +346,4 @@ def bathymetric(dictionary, alpha=1.5):
         Array containing the values of the bathymetric composite.
     '''
     
-    bath = np.stack([dictionary["B04"], dictionary["B03"], dictionary["B01"]], axis=-1)
-    return bath[0]*alpha
+    return build(dictionary, ("B04", "B03", "B01"), alpha, dtype, output)
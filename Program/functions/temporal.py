@@ -0,0 +1,188 @@
+import os
+import argparse
+import warnings
+from contextlib import ExitStack
+import numpy as np
+import rasterio as rs
+from rasterio.enums import Resampling
+from functions import bands
+from functions import indices
+from functions import tiling
+from functions import writers
+from functions import metrics
+from functions.timeseries import scenes, date_of
+
+# Ways of reducing the dates of each pixel. "max-ndvi" takes every band from the date with the
+# highest NDVI, the one least likely to be cloudy.
+METHODS = ("median", "mean", "max", "max-ndvi")
+
+# Side in pixels of the windows. The median, and the NDVI of max-ndvi, keep one window per date
+# in memory, so their memory is the number of dates times the size of a window.
+WINDOW = 512
+
+def _values(src, window):
+    # Lee una ventana como float32, con el nodata (0) como NaN
+    values = src.read(1, window=window).astype("float32")
+    values[values == 0] = np.nan
+    return values
+
+def _ndvi(red, nir, window, shape):
+    # NDVI sin normalizar de una ventana con la fórmula de indices.ndvi
+    pair = {"B04": tiling.read_window(red, window, shape, Resampling.bilinear).astype("float32"),
+            "B08": tiling.read_window(nir, window, shape, Resampling.bilinear).astype("float32")}
+    return indices.FORMULAS["ndvi"].evaluate(pair)
+
+def reduce(sources, window, method="median", ndvi=None):
+    '''
+    Description
+    -----------
+    Reduces a window of a band over several dates. The mean, the maximum and the max-NDVI
+    selection go through the dates once keeping only running arrays the size of the window;
+    the median reads the window of every date and sorts them, so its memory is bounded by the
+    size of the window times the number of dates. Pixels without data (0) in a date are left
+    out of that date.
+
+    Parameters
+    -----------
+    sources: list
+        Open rasterio datasets of the band, one per date, on the same grid.
+    window: Window
+        Window of the grid of the band.
+    method: str, optional
+        One of METHODS. Default is "median".
+    ndvi: list, optional
+        NDVI of the window in each date, on the grid of the band, needed by "max-ndvi". It
+        depends only on the window and the grid, so composite() computes it once for all the
+        bands on the same grid.
+
+    Returns
+    -------
+    window: ndarray
+        2D float32 array with NaN where no date has data.
+    '''
+    if method == "median":
+        stack = np.stack([_values(src, window) for src in sources])
+        with warnings.catch_warnings():
+            # Píxeles sin datos en ninguna fecha
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanmedian(stack, axis=0)
+    if method == "mean":
+        total = np.zeros((window.height, window.width), dtype="float64")
+        count = np.zeros(total.shape, dtype="int32")
+        for src in sources:
+            values = _values(src, window)
+            valid = ~np.isnan(values)
+            total[valid] += values[valid]
+            count += valid
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (total / count).astype("float32")
+    if method == "max":
+        result = np.full((window.height, window.width), np.nan, dtype="float32")
+        for src in sources:
+            np.fmax(result, _values(src, window), out=result)
+        return result
+    if method == "max-ndvi":
+        result = np.full((window.height, window.width), np.nan, dtype="float32")
+        best = np.full(result.shape, -np.inf, dtype="float32")
+        for src, index in zip(sources, ndvi):
+            values = _values(src, window)
+            # Las comparaciones con NaN son falsas, así que los píxeles sin datos no se eligen
+            better = (index > best) & ~np.isnan(values)
+            result[better] = values[better]
+            best[better] = index[better]
+        return result
+    raise ValueError(f"Unknown method {method!r}, use one of {METHODS}")
+
+def composite(paths, out_path: str, method="median", codes=None, size=WINDOW, compress="deflate"):
+    '''
+    Description
+    -----------
+    Builds a temporal composite of several dates of the same tile, window by window over the
+    bands on the same native grid, and writes each band to a Cloud-Optimized GeoTIFF at its
+    native resolution and in its original data type, named as a scene so the folder can be read
+    by read() and used by the compositions and indices as any other scene:
+
+    >>> temporal.composite(["/data/T14QLG_20230101", "/data/T14QLG_20230106"], "/data/median")
+    >>> simple.natural_color(read(1, 12, "/data/median"))
+
+    Parameters
+    -----------
+    paths: list
+        Folders of the scenes, one per date.
+    out_path: str
+        Folder where the bands of the composite are written. It is created if needed.
+    method: str, optional
+        One of METHODS. Default is "median".
+    codes: list, optional
+        Codes of the bands to composite. Default is None, which takes the bands found in every
+        scene. B02 is needed by read().
+    size: int, optional
+        Side in pixels of the windows. Default is WINDOW.
+    compress: str, optional
+        "deflate" or "zstd". Default is "deflate".
+
+    Returns
+    -------
+    files: dict
+        Dictionary that maps each band code to the full path of its file.
+    '''
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method!r}, use one of {METHODS}")
+    found = [bands.find(path) for path in paths]
+    if codes is None:
+        codes = [code for code in found[0] if all(code in files for files in found)]
+    dates = [date_of(path) or os.path.basename(os.path.normpath(path)) for path in paths]
+    name = f"{method.upper().replace('-', '')}_{min(dates)}_{max(dates)}"
+    os.makedirs(out_path, exist_ok=True)
+    # Las bandas de la misma rejilla se recorren juntas, así el NDVI de cada ventana se lee una vez
+    grids = dict()
+    for code in codes:
+        grids.setdefault(bands.shape_of(found[0][code]), list()).append(code)
+    written = dict()
+    for shape, group in grids.items():
+        temporaries = dict()
+        with metrics.stage("composite"), ExitStack() as stack:
+            sources, outputs, limits = dict(), dict(), dict()
+            for code in group:
+                sources[code] = [stack.enter_context(rs.open(files[code])) for files in found]
+                if any((src.height, src.width) != shape for src in sources[code]):
+                    raise ValueError(f"The {code} bands of the scenes are not on the same grid")
+                first = sources[code][0]
+                profile = writers.profile(first.crs, first.transform, shape, size=writers.BLOCK)
+                profile.update(dtype=first.dtypes[0], nodata=0)
+                limits[code] = np.iinfo(profile["dtype"]) if np.dtype(profile["dtype"]).kind in "iu" else None
+                temporaries[code] = os.path.join(out_path, f"{name}_{code}.tif.tmp")
+                outputs[code] = stack.enter_context(rs.open(temporaries[code], "w", **profile))
+            pairs = None
+            if method == "max-ndvi":
+                pairs = [(stack.enter_context(rs.open(files["B04"])), stack.enter_context(rs.open(files["B08"])))
+                         for files in found]
+            for window in tiling.windows(shape, size):
+                ndvi = None if pairs is None else [_ndvi(red, nir, window, shape) for red, nir in pairs]
+                for code in group:
+                    result = reduce(sources[code], window, method, ndvi)
+                    result[np.isnan(result)] = 0
+                    info = limits[code]
+                    if info is not None:
+                        result = np.clip(np.round(result), info.min, info.max)
+                    outputs[code].write(result.astype(outputs[code].dtypes[0]), 1, window=window)
+        for code in group:
+            written[code] = writers.cog(temporaries[code], os.path.join(out_path, f"{name}_{code}.tif"), compress)
+    return {code: written[code] for code in codes}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a temporal composite of the scenes of a directory.")
+    parser.add_argument("directory", help="directory with one folder of .tif images per date")
+    parser.add_argument("output", help="folder where the bands of the composite are written")
+    parser.add_argument("-m", "--method", default="median", choices=METHODS, help="reduction of the dates")
+    parser.add_argument("-b", "--band", action="append", help="band to composite, can be repeated; all by default")
+    parser.add_argument("--start", help="first date, YYYYMMDD")
+    parser.add_argument("--end", help="last date, YYYYMMDD")
+    parser.add_argument("--window", type=int, default=WINDOW, help="side in pixels of the windows")
+    args = parser.parse_args()
+    paths = [path for date, path in scenes(args.directory)
+             if (args.start is None or date >= args.start) and (args.end is None or date <= args.end)]
+    if not paths:
+        parser.error("no scene found between the given dates")
+    files = composite(paths, args.output, args.method, args.band, args.window)
+    print(f"{len(files)} bands of {len(paths)} dates written to {args.output}")
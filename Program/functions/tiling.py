@@ -0,0 +1,308 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+from collections import deque
+import numpy as np
+import rasterio as rs
+from rasterio.windows import Window
+from functions import indices
+from functions import writers
+from functions import metrics
+from functions import normalize
+from functions.expression import Expression
+from functions.bands import on_grid
+
+# Side in pixels of the square windows the scene is processed in. It must be a multiple
+# of 16 because the output GeoTIFF is tiled with the same block size.
+WINDOW = 1024
+
+# Datasets opened by each process of the pool, see _open().
+_state = dict()
+
+def windows(shape: tuple, size=WINDOW):
+    '''
+    Description
+    -----------
+    Splits a grid into square windows of a given size, row by row. The windows of the last
+    row and column are cropped to the grid.
+
+    Parameters
+    -----------
+    shape: tuple
+        (height, width) of the grid.
+    size: int, optional
+        Side in pixels of the windows. Default is WINDOW.
+
+    Returns
+    -------
+    windows: generator
+        Generator of rasterio Window objects.
+    '''
+    height, width = shape
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            yield Window(col, row, min(size, width - col), min(size, height - row))
+
+def read_window(src, window: Window, shape: tuple, resampling):
+    '''
+    Description
+    -----------
+    Reads the part of a band that covers a window of the target grid, resampled to the size
+    of the window. The window is scaled to the pixel coordinates of the band, so bands with a
+    different resolution are read from the same area of the scene.
+
+    Parameters
+    -----------
+    src: DatasetReader
+        Open rasterio dataset of the band.
+    window: Window
+        Window in pixel coordinates of the target grid.
+    shape: tuple
+        (height, width) of the target grid.
+    resampling: Resampling
+        Resampling method.
+
+    Returns
+    -------
+    band: ndarray
+        2D array with the shape of the window.
+    '''
+    sy = src.height / shape[0]
+    sx = src.width / shape[1]
+    src_window = Window(window.col_off * sx, window.row_off * sy, window.width * sx, window.height * sy)
+    return src.read(1, window=src_window, out_shape=(window.height, window.width), resampling=resampling)
+
+def _open(paths: list, formulas: list, shape: tuple, resamplings: list, dtype, stretch="max", mask=None):
+    '''
+    Opens the bands of the indices once per process so every window computed by that process
+    reuses the same rasterio datasets, and compiles their formulas together. It is the
+    initializer of the pool.
+    '''
+    _close()
+    _state["sources"] = [rs.open(file_path) for file_path in paths]
+    _state["formula"] = Expression(list(formulas))
+    _state["shape"] = shape
+    # Un método por banda, ver Bands.method()
+    _state["resampling"] = resamplings
+    _state["dtype"] = np.dtype(dtype)
+    _state["stretch"] = stretch
+    _state["mask"] = mask
+    _state["masking"] = None if mask is None else mask.open()
+
+def _close():
+    '''
+    Closes the datasets opened by _open() in the current process.
+    '''
+    for src in _state.pop("sources", []):
+        src.close()
+    if _state.get("masking") is not None:
+        _state.pop("masking").close()
+
+def _compute(window: Window, divisors: list):
+    '''
+    Computes the not yet normalized indices over a window with the datasets opened by _open(),
+    dividing each band by its maximum inside the evaluation of the formulas, or by its
+    percentile and clipping it with the "percentile" stretch. With a mask, the masked pixels
+    are NaN, and windows that are masked whole are not read nor computed.
+    The serial and the parallel paths both go through this function, so they give the same
+    values bit for bit.
+    '''
+    formula = _state["formula"]
+    dtype, stretch, mask = _state["dtype"], _state["stretch"], _state["mask"]
+    invalid = None
+    if mask is not None:
+        invalid = mask.window(_state["masking"], window, _state["shape"])
+        if invalid.all():
+            metrics.count("masked_windows")
+            return [np.full((window.height, window.width), np.nan, dtype="float32") for _ in formula.results]
+    with metrics.stage("decode+resample"):
+        bands = {code: read_window(src, window, _state["shape"], resampling)
+                 for code, src, resampling in zip(formula.bands, _state["sources"], _state["resampling"])}
+    with metrics.stage("index"):
+        if stretch == "max":
+            results = formula.evaluate(bands, dict(zip(formula.bands, divisors)), dtype=dtype)
+        else:
+            bands = {code: normalize.apply(band.astype(dtype), divisor, stretch, out=None)
+                     for (code, band), divisor in zip(bands.items(), divisors)}
+            results = formula.evaluate(bands, dtype=dtype)
+        results = [index.astype("float32", copy=False) for index in results]
+        if invalid is not None:
+            for index in results:
+                index[invalid] = np.nan
+        return results
+
+def stream(images, name: str, out_path: str, size=WINDOW, workers=1, encoding="float32", compress="deflate",
+           stretch="max"):
+    '''
+    Description
+    -----------
+    Computes an index window by window and writes it to a Cloud-Optimized GeoTIFF, so the
+    memory used depends on the size of the windows and not on the size of the scene. It makes
+    three passes:
+
+    1. The statistics of each band are gathered block by block at its native resolution.
+    2. For each window, the bands are read and resampled to the window, normalized by their
+       maximum, the formula of the index is applied and the result is written to an
+       uncompressed temporary file while the statistics of the index are gathered.
+    3. The temporary index is divided by its maximum, window by window, encoded and copied to
+       a tiled, compressed Cloud-Optimized GeoTIFF with overviews and the georeference of the
+       scene (see functions/writers.py).
+
+    With the "percentile" stretch, the statistics include a histogram and the bands and the
+    index are divided by their percentile instead of their maximum and clipped to 1 (see
+    functions/normalize.py); the passes are the same.
+
+    When the bands have a mask, the masked pixels are left out of the statistics and written as
+    nodata, and the windows that are masked whole, e.g. fully cloudy, are neither read nor
+    computed.
+
+    With more than one worker, the first two passes are spread across a pool of processes.
+    Each process opens its own rasterio datasets and the windows are written in the same order
+    as in the serial path, so the output is identical whatever the number of workers. At most
+    two windows per worker are submitted ahead of the one being written, so finished windows
+    never pile up in memory when the workers are faster than the writer.
+
+    The result matches indices.compute() except that the bands are normalized by their native
+    maximum, which can differ slightly from the maximum of the cubic-resampled band.
+
+    Parameters
+    -----------
+    images: Bands
+        Bands of the scene, as returned by read(). Only their files, resampling method, data
+        type and the grid chosen by their resolution policy are used; no band is loaded in memory.
+    name: str
+        Name of the index as registered in indices.INDICES, e.g. "ndvi".
+    out_path: str
+        Full path of the GeoTIFF to be written.
+    size: int, optional
+        Side in pixels of the windows. Default is WINDOW.
+    workers: int, optional
+        Number of processes used to compute the windows. Default is 1, which computes
+        everything in the current process.
+    encoding: str, optional
+        "float32", or "int16" to store the values scaled by 10000. Default is "float32".
+    compress: str, optional
+        "deflate" or "zstd". Default is "deflate".
+    stretch: str, optional
+        "max" or "percentile". Default is "max".
+
+    Returns
+    -------
+    out_path: str
+        Full path of the written GeoTIFF.
+
+    Examples
+    --------
+    >>> images = read(1, 12, path)
+    >>> tiling.stream(images, "ndvi", os.path.join(path, "ndvi.tif"), size=512, workers=8)
+    '''
+    return stream_many(images, {name: out_path}, size, workers, encoding, compress, stretch)[name]
+
+def stream_many(images, outputs: dict, size=WINDOW, workers=1, encoding="float32", compress="deflate",
+                stretch="max"):
+    '''
+    Description
+    -----------
+    Computes several indices in one sweep over the windows of the scene, as stream() does for
+    one. The indices computed on the same grid share a single read of each band per window,
+    a single computation of the statistics of each band and their common subexpressions, e.g.
+    B08 + B04 is computed once for the NDVI and the SAVI.
+
+    Parameters
+    -----------
+    images: Bands
+        Bands of the scene, as returned by read().
+    outputs: dict
+        Dictionary that maps the name of each index to the full path of its GeoTIFF.
+    size: int, optional
+        Side in pixels of the windows. Default is WINDOW.
+    workers: int, optional
+        Number of processes used to compute the windows. Default is 1.
+    encoding: str, optional
+        "float32" or "int16". Default is "float32".
+    compress: str, optional
+        "deflate" or "zstd". Default is "deflate".
+    stretch: str, optional
+        "max" or "percentile". Default is "max".
+
+    Returns
+    -------
+    outputs: dict
+        The same dictionary of written GeoTIFFs.
+
+    Examples
+    --------
+    >>> tiling.stream_many(images, {"ndvi": "ndvi.tif", "ndmi": "ndmi.tif", "nbri": "nbri.tif"})
+    '''
+    groups = dict()
+    for name in outputs:
+        grid = on_grid(images, indices.FORMULAS[name].bands)
+        groups.setdefault(grid.shape, (grid, list()))[1].append(name)
+    for grid, names in groups.values():
+        _sweep(grid, names, [outputs[name] for name in names], size, workers, encoding, compress, stretch)
+    return outputs
+
+def _sweep(images, names: list, out_paths: list, size: int, workers: int, encoding: str, compress: str,
+           stretch: str):
+    '''
+    Computes indices that share the grid of images in one pass over its windows. See stream().
+    '''
+    formulas = [indices.INDICES[name] for name in names]
+    codes = Expression(formulas).bands
+    paths = [images.files[band] for band in codes]
+    temporaries = [f"{out_path}.tmp" for out_path in out_paths]
+    crs, transform = writers.georeference(images, codes)
+    out_profile = writers.profile(crs, transform, images.shape, "float32", size)
+    bins = normalize.bins_for(stretch)
+    statistics = [normalize.Statistics(bins) for _ in names]
+    with ExitStack() as stack:
+        targets = [stack.enter_context(rs.open(temporary, "w", **out_profile))
+                   for temporary in temporaries]
+
+        def write(window, results):
+            with metrics.stage("write"):
+                for dst, index, gathered in zip(targets, results, statistics):
+                    gathered.update(index)
+                    dst.write(index, 1, window=window)
+
+        mask = images.mask
+        resamplings = [images.method(code) for code in codes]
+        initargs = (paths, formulas, images.shape, resamplings, images.dtype, stretch, mask)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_open, initargs=initargs) as pool:
+                with metrics.stage("statistics"):
+                    divisors = [band.divisor(stretch)
+                                for band in pool.map(normalize.statistics, paths, repeat(bins), repeat(mask))]
+                # Como mucho 2 ventanas por proceso en vuelo, para que la memoria no dependa de la escena
+                pending = deque()
+                for window in windows(images.shape, size):
+                    pending.append((window, pool.submit(_compute, window, divisors)))
+                    if len(pending) >= 2 * workers:
+                        window, future = pending.popleft()
+                        write(window, future.result())
+                while pending:
+                    window, future = pending.popleft()
+                    write(window, future.result())
+        else:
+            with metrics.stage("statistics"):
+                divisors = [normalize.statistics(file_path, bins, mask).divisor(stretch) for file_path in paths]
+            _open(*initargs)
+            try:
+                for window in windows(images.shape, size):
+                    write(window, _compute(window, divisors))
+            finally:
+                _close()
+    # Normalización de cada índice con sus estadísticas globales
+    encoded_profile = writers.profile(crs, transform, images.shape, encoding, size)
+    for temporary, out_path, gathered in zip(temporaries, out_paths, statistics):
+        divisor = np.float32(gathered.divisor(stretch))
+        encoded = f"{out_path}.encoded.tmp"
+        with metrics.stage("normalize"), rs.open(temporary) as src, rs.open(encoded, "w", **encoded_profile) as dst:
+            if encoding != "float32":
+                dst.scales = (writers.ENCODINGS[encoding]["scale"],)
+            for window in windows(images.shape, size):
+                index = normalize.apply(src.read(1, window=window), divisor, stretch)
+                dst.write(writers.encode(index, encoding), 1, window=window)
+        os.remove(temporary)
+        writers.cog(encoded, out_path, compress)
@@ -0,0 +1,232 @@
+import os
+import re
+import argparse
+import numpy as np
+from functions import bands
+from functions import indices
+from functions import writers
+from functions import normalize
+from functions import cache
+from functions import safe
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# Acquisition date in the Sentinel-2 naming conventions, e.g. "T14QLG_20230101T170000_B02.tif",
+# or alone, as in the scene folders of the program, e.g. "T14QLG_20230101".
+DATE = re.compile(r"(?<!\d)(\d{8})(?:T\d{6})?(?!\d)")
+
+# Side in pixels of the spatial chunks of the stacks. Each chunk holds one date.
+CHUNK = 512
+
+def date_of(path: str):
+    '''
+    Returns the acquisition date of a scene folder or product as "YYYYMMDD", taken from its name
+    or else from the name of its first TIF file, or None if there is none.
+    '''
+    names = [os.path.basename(os.path.normpath(path))]
+    if os.path.isdir(path):
+        names += sorted(file for file in os.listdir(path) if file.endswith(".tif"))
+    for name in names:
+        match = DATE.search(name)
+        if match:
+            return match.group(1)
+    return None
+
+def scenes(directory: str):
+    '''
+    Description
+    -----------
+    Lists the scene folders, .SAFE directories and .zip products of a directory that have an
+    acquisition date, sorted by date. Each date appears once: if there are several scenes of a
+    date, such as a .zip product and its extracted .SAFE directory, the first folder is kept,
+    which is faster to read than the .zip.
+
+    Parameters
+    -----------
+    directory: str
+        Full path of the directory that contains one folder per date.
+
+    Returns
+    -------
+    scenes: list
+        (date, path) of every scene.
+    '''
+    found = list()
+    for folder in sorted(os.listdir(directory)):
+        path = os.path.join(directory, folder)
+        # Compositions guarda los productos de los .zip de la carpeta
+        if folder != "Compositions" and (os.path.isdir(path) or safe.is_product(path)):
+            date = date_of(path)
+            if date is not None:
+                found.append((date, path))
+    # Las carpetas van antes que los .zip de la misma fecha
+    found.sort(key=lambda scene: (scene[0], not os.path.isdir(scene[1]), scene[1]))
+    dates = set()
+    unique = list()
+    for date, path in found:
+        if date not in dates:
+            dates.add(date)
+            unique.append((date, path))
+    return unique
+
+class Store:
+    '''
+    Description
+    -----------
+    Zarr store with one (time, y, x) float32 array per index, chunked with one date per chunk
+    and CHUNK x CHUNK pixels, so adding a date writes only its own chunks and reading the trend
+    of an area reads only the chunks of that area. The dates of the layers of each array are
+    kept in its "dates" attribute, in the order they were added, together with the
+    georeference of the grid.
+
+    Parameters
+    -----------
+    path: str
+        Full path of the store, e.g. "/data/T14QLG.zarr". It is created if it does not exist.
+
+    Examples
+    --------
+    >>> store = Store("/data/T14QLG.zarr")
+    >>> store.dates("ndvi")
+    ['20230101', '20230106']
+    >>> ndvi = store.array("ndvi")[:, 1000, 2000] # NDVI of one pixel over time
+    '''
+
+    def __init__(self, path: str):
+        if zarr is None:
+            raise ImportError("Time series need zarr: pip install zarr")
+        self.path = path
+        self.group = zarr.open_group(path, mode="a")
+
+    def __contains__(self, name):
+        return name in self.group
+
+    def array(self, name: str):
+        '''
+        Returns the zarr array of an index.
+        '''
+        return self.group[name]
+
+    def dates(self, name: str):
+        '''
+        Returns the dates already stored for an index, or an empty list.
+        '''
+        if name not in self.group:
+            return list()
+        return list(self.group[name].attrs.get("dates", []))
+
+    def append(self, name: str, date: str, layer, crs=None, transform=None):
+        '''
+        Description
+        -----------
+        Adds the layer of a date to the array of an index, creating the array with the first
+        one. The date is recorded after its layer is written, so a run that is interrupted
+        leaves no date without data and the date is computed again by the next run.
+
+        Parameters
+        -----------
+        name: str
+            Name of the index.
+        date: str
+            Acquisition date, "YYYYMMDD".
+        layer: ndarray
+            2D array of the index.
+        crs: CRS, optional
+            Coordinate reference system of the grid, stored with the first layer.
+        transform: Affine, optional
+            Geotransform of the grid, stored with the first layer.
+        '''
+        height, width = layer.shape
+        if name not in self.group:
+            create = getattr(self.group, "create_array", None) or self.group.create_dataset
+            array = create(name, shape=(0, height, width), chunks=(1, min(CHUNK, height), min(CHUNK, width)),
+                           dtype="float32", fill_value=np.nan)
+            array.attrs.update({"dates": [], "crs": None if crs is None else crs.to_wkt(),
+                                "transform": None if transform is None else list(transform)[:6]})
+        array = self.group[name]
+        if array.shape[1:] != (height, width):
+            raise ValueError(f"The layer of {date} has shape {(height, width)}, but the stack of {name} "
+                             f"has {array.shape[1:]}; every date must be on the same grid")
+        dates = self.dates(name)
+        # Las capas de una ejecución interrumpida se sobrescriben
+        array.resize((len(dates) + 1, height, width))
+        array[len(dates)] = layer.astype("float32", copy=False)
+        array.attrs["dates"] = dates + [date]
+
+def update(directory: str, store_path: str, names, dtype="float32", resolution="finest", stretch="max",
+           cache=None, verbose=True):
+    '''
+    Description
+    -----------
+    Brings the time series of some indices up to date: only the dates of the directory that are
+    not yet in the store for an index are read and computed, and their layers are appended to
+    it. The indices of a date are computed in one pass, as indices.batch() does, so only the
+    bands they need are read.
+
+    Parameters
+    -----------
+    directory: str
+        Full path of the directory that contains one folder per date, see scenes().
+    store_path: str
+        Full path of the zarr store.
+    names: list
+        Names of the indices as registered in indices.INDICES, e.g. ["ndvi", "ndmi"].
+    dtype: str, optional
+        Data type used for the computation. Default is "float32".
+    resolution: str, optional
+        Resolution policy of the bands, see read(). Default is "finest".
+    stretch: str, optional
+        Normalization of the bands and indices, "max" or "percentile". Default is "max".
+    cache: Cache, optional
+        On-disk cache of resampled bands. Default is None.
+    verbose: bool, optional
+        Whether to print each date as it is processed. Default is True.
+
+    Returns
+    -------
+    added: dict
+        Dictionary that maps each processed date to the names of the indices added for it.
+
+    Examples
+    --------
+    >>> timeseries.update("/data/T14QLG", "/data/T14QLG.zarr", ["ndvi", "ndmi"])
+    {'20230111': ['ndvi', 'ndmi']}
+    '''
+    store = Store(store_path)
+    stored = {name: set(store.dates(name)) for name in names}
+    added = dict()
+    for date, path in scenes(directory):
+        missing = [name for name in names if date not in stored[name]]
+        if not missing:
+            continue
+        if verbose:
+            print(f"{bands.GREEN}{date}: computing {', '.join(missing)}{bands.RESET}")
+        files = bands.find(path)
+        images = bands.Bands(files, bands.shape_of(files[bands.REFERENCE]), dtype=dtype, resolution=resolution,
+                             cache=cache, verbose=False, stretch=stretch)
+        for name, layer in indices.batch(images, missing, dtype, stretch).items():
+            crs, transform = writers.georeference(images, indices.FORMULAS[name].bands)
+            store.append(name, date, layer, crs, transform)
+            stored[name].add(date)
+        added[date] = missing
+    return added
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append the indices of new dates to a zarr time series.")
+    parser.add_argument("directory", help="directory with one folder of .tif images per date")
+    parser.add_argument("store", help="zarr store, created if it does not exist")
+    parser.add_argument("-i", "--index", action="append", required=True, choices=sorted(indices.INDICES),
+                        help="index to keep a time series of, can be repeated")
+    parser.add_argument("--dtype", default="float32", help="data type of the computation")
+    parser.add_argument("--resolution", default="finest", help='grid of each index: "finest", "coarsest" or a band code')
+    parser.add_argument("--stretch", default="max", choices=normalize.STRETCHES, help="normalization of the bands and indices")
+    parser.add_argument("--cache", nargs="?", const=cache.DIRECTORY, metavar="DIR",
+                        help="keep the resampled bands in an on-disk cache, in the given folder or in "
+                             f"{cache.DIRECTORY}; off by default, since each date is read only once")
+    args = parser.parse_args()
+    added = update(args.directory, args.store, args.index, args.dtype, args.resolution, args.stretch,
+                   None if args.cache is None else cache.Cache(args.cache))
+    print(f"{len(added)} new dates added to {args.store}")
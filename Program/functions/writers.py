@@ -0,0 +1,180 @@
+import os
+import numpy as np
+import rasterio as rs
+import rasterio.shutil
+from rasterio.windows import Window
+from functions.bands import on_grid
+from functions import metrics
+
+# Side in pixels of the internal tiles of the Cloud-Optimized GeoTIFFs.
+BLOCK = 512
+
+# Data type, nodata value and scale of each encoding. The int16 encoding stores round(value / scale),
+# which keeps four decimals of the normalized indices with half the size of float32.
+ENCODINGS = {
+    "float32": {"dtype": "float32", "nodata": np.nan, "scale": 1.0},
+    "int16": {"dtype": "int16", "nodata": -32768, "scale": 1e-4},
+}
+
+def encode(array, encoding="float32"):
+    '''
+    Description
+    -----------
+    Converts an array of index values to the data type of an encoding. NaN values become the
+    nodata value of the encoding.
+
+    Parameters
+    -----------
+    array: ndarray
+        Array containing the values of the index.
+    encoding: str, optional
+        "float32" or "int16". Default is "float32".
+
+    Returns
+    -------
+    array: ndarray
+        Encoded array.
+    '''
+    spec = ENCODINGS[encoding]
+    if encoding == "float32":
+        return array.astype("float32", copy=False)
+    info = np.iinfo(spec["dtype"])
+    encoded = np.round(array / spec["scale"])
+    np.clip(encoded, info.min + 1, info.max, out=encoded)
+    encoded[np.isnan(encoded)] = spec["nodata"]
+    return encoded.astype(spec["dtype"])
+
+def profile(crs, transform, shape: tuple, encoding="float32", size=BLOCK):
+    '''
+    Description
+    -----------
+    Builds the profile of an uncompressed, tiled single-band GeoTIFF in the data type of an
+    encoding, used as the intermediate file of cog().
+
+    Parameters
+    -----------
+    crs: CRS
+        Coordinate reference system of the scene.
+    transform: Affine
+        Geotransform of the output grid.
+    shape: tuple
+        (height, width) of the output grid.
+    encoding: str, optional
+        "float32" or "int16". Default is "float32".
+    size: int, optional
+        Side in pixels of the tiles. Default is BLOCK.
+
+    Returns
+    -------
+    profile: dict
+        Keyword arguments for rasterio.open() in write mode.
+    '''
+    spec = ENCODINGS[encoding]
+    return {"driver": "GTiff", "height": shape[0], "width": shape[1], "count": 1,
+            "dtype": spec["dtype"], "nodata": spec["nodata"], "crs": crs, "transform": transform,
+            "tiled": True, "blockxsize": size, "blockysize": size, "BIGTIFF": "IF_SAFER"}
+
+def cog(temporary: str, out_path: str, compress="deflate", size=BLOCK, remove=True):
+    '''
+    Description
+    -----------
+    Copies a tiled GeoTIFF to a Cloud-Optimized GeoTIFF with internal overviews computed by
+    averaging, using the COG driver of GDAL. The copy reads the source block by block, so the
+    raster is never loaded whole in memory.
+
+    Parameters
+    -----------
+    temporary: str
+        Full path of the tiled GeoTIFF to be copied.
+    out_path: str
+        Full path of the Cloud-Optimized GeoTIFF.
+    compress: str, optional
+        "deflate" or "zstd". Default is "deflate".
+    size: int, optional
+        Side in pixels of the tiles. Default is BLOCK.
+    remove: bool, optional
+        Whether to remove the source file after the copy. Default is True.
+
+    Returns
+    -------
+    out_path: str
+        Full path of the written file.
+    '''
+    with rs.open(temporary) as src:
+        predictor = 3 if src.dtypes[0].startswith("float") else 2
+    with metrics.stage("cog"):
+        rasterio.shutil.copy(temporary, out_path, driver="COG", compress=compress.upper(), predictor=predictor,
+                             blocksize=size, overview_resampling="average", bigtiff="IF_SAFER")
+    metrics.count("bytes_written", os.path.getsize(out_path))
+    if remove:
+        os.remove(temporary)
+    return out_path
+
+def write(array, out_path: str, crs, transform, encoding="float32", compress="deflate", size=BLOCK):
+    '''
+    Description
+    -----------
+    Writes an index computed in memory to a Cloud-Optimized GeoTIFF. The array is encoded and
+    written tile by tile to an intermediate file, so only one tile is converted at a time.
+
+    Parameters
+    -----------
+    array: ndarray
+        2D array containing the values of the index.
+    out_path: str
+        Full path of the Cloud-Optimized GeoTIFF.
+    crs: CRS
+        Coordinate reference system of the scene.
+    transform: Affine
+        Geotransform of the grid of the array.
+    encoding: str, optional
+        "float32" or "int16". Default is "float32".
+    compress: str, optional
+        "deflate" or "zstd". Default is "deflate".
+    size: int, optional
+        Side in pixels of the tiles. Default is BLOCK.
+
+    Returns
+    -------
+    out_path: str
+        Full path of the written file.
+
+    Examples
+    --------
+    >>> crs, transform = writers.georeference(images, ("B08", "B04"))
+    >>> writers.write(indices.ndvi(images), "ndvi.tif", crs, transform, encoding="int16")
+    '''
+    temporary = f"{out_path}.tmp"
+    height, width = array.shape
+    with metrics.stage("write"), rs.open(temporary, "w", **profile(crs, transform, array.shape, encoding, size)) as dst:
+        if encoding != "float32":
+            dst.scales = (ENCODINGS[encoding]["scale"],)
+        for row in range(0, height, size):
+            for col in range(0, width, size):
+                window = Window(col, row, min(size, width - col), min(size, height - row))
+                dst.write(encode(array[row:row + size, col:col + size], encoding), 1, window=window)
+    return cog(temporary, out_path, compress, size)
+
+def georeference(images, names):
+    '''
+    Description
+    -----------
+    Returns the coordinate reference system and the geotransform of the grid an operation on
+    the given bands is computed on, taken from the dataset of the first band.
+
+    Parameters
+    -----------
+    images: Bands
+        Bands of the scene, as returned by read().
+    names: iterable
+        Codes of the bands used by the operation.
+
+    Returns
+    -------
+    crs, transform: CRS, Affine
+        Georeference of the grid.
+    '''
+    grid = on_grid(images, names)
+    with rs.open(grid.files[next(iter(names))]) as src:
+        transform = src.transform * src.transform.scale(src.width / grid.shape[1], src.height / grid.shape[0])
+        return src.crs, transform
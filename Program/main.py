@@ -1,10 +1,9 @@
 from functions import simple
 from functions import indices
-import os
-from time import perf_counter
-import rasterio as rs
-from rasterio.enums import Resampling
-import numpy as np
+from functions import bands
+from functions import cache
+from functions import mask as masks
+from functions import safe
 
 GREEN = "\u001B[32m"
 RED = "\u001B[31m"
@@ -13,25 +12,33 @@ YELLOW = "\u001B[33m"
 RESET = "\u001B[0m"
 
 
-def read(start: int, end: int, path: str):
+def read(start: int, end: int, path: str, dtype="float32", resolution="finest", cache=None, preview=None,
+         stretch="max", mask=None, threads=bands.THREADS):
     '''
     Description
     -----------
-    Reads the files of a directory and check if they are in TIF file to select them, read them 
-    using rasterio and add them to a dictionary containing the corresponding band name.
-    It creates a range of numbers given the start and end, so that all images in between are taken
-    into account.
+    Finds the TIF files of the bands in a directory and returns a dictionary-like object that
+    reads each band, with rasterio, the first time it is used. Only the bands whose number lies
+    between start and end (both included) are taken into account; B8A is treated as band 8.
 
-    Once the images are saved in the dictionary, it takes the largest height of the images and the
-    largest width for the followin interpolation. The images are passed through the read() function
-    of rasterio and an out_shape is defined as follows:
+    The height and width of the highest-resolution image (B02) are taken from its metadata, without
+    decoding it, and used as the out_shape of the read() function of rasterio:
 
-    >>> height = len(images["B2"][0]) # height in pixels of the highest-resolution image
-    >>> width = len(images["B2"][1]) # width in pixels of the highest-resolution image
-    >>> out_shape=(height, width)
+    >>> height, width = bands.shape_of(files["B02"]) # dimensions in pixels of B02
+    >>> out_shape=(1, height, width)
 
-    Then a cubic resampling method is used to interpolate the images and make them all have the same
-    spatial resolution.
+    No band is read here. Each composition or index reads the bands it uses, and only those,
+    the first time it needs them, and they are kept for the next ones. With the default
+    resolution policy, they are brought to the finest native grid among them, so an index of
+    20 m bands stays at 20 m. The bands of an operation are read at the same time by several
+    threads, and the ones that share a native grid and a resampling method in a single
+    multi-band read. Bands brought to a coarser grid are averaged, B11 and B12 are upsampled with
+    a bilinear resampling and the rest with a cubic one. Each file is opened and decoded once
+    and closed right after, and the open, decode/resample and normalization times are printed
+    when it is read.
+
+    A Sentinel-2 .SAFE directory or .zip archive can be given as path: its JP2 bands are found
+    from its manifest and read directly, through GDAL's /vsizip/ for archives.
 
     Parameters 
     ----------- 
@@ -40,41 +47,53 @@ def read(start: int, end: int, path: str):
     end: int
         Ending number of the range of bands you wish to read.
     path: str
-        Full path of the directory in which the images are to be found.
+        Full path of the directory in which the images are to be found, or of the product.
+    dtype: str, optional
+        Data type of the normalized images. Default is "float32".
+    resolution: str, optional
+        Grid each composition or index is computed on: "finest" or "coarsest" native grid among
+        the bands it uses, a band code such as "B02" to always use the grid of that band, or None
+        to always use the grid of B02. Default is "finest".
+    cache: Cache, optional
+        On-disk cache of resampled images, so later runs map them instead of resampling them
+        again. Default is None.
+    preview: int, optional
+        Largest side in pixels of the images, for quicklooks. The images are read directly at
+        that size, from their internal overviews when they have them, with an average
+        resampling, and compositions and indices are computed at that size. Default is None,
+        which reads them at full resolution.
+    stretch: str, optional
+        Normalization of the images: "max" divides each one by its maximum, "percentile" by its
+        99th percentile, clipping the values above it to 1, so a few saturated pixels do not
+        darken the whole image. Default is "max".
+    mask: str, optional
+        Pixels to leave out: "scl" masks the nodata, saturated, cloud, cloud shadow and cirrus
+        pixels given by the SCL file of the Level-2A scene, and the path of a raster masks its
+        nonzero pixels. The masked pixels are NaN in the images, indices and GeoTIFFs, and are
+        left out of the normalization. Default is None, which masks nothing.
+    threads: int, optional
+        Number of bands of a composition or index read at the same time. GDAL decodes and
+        resamples them without holding the GIL, so they take about as long as the slowest one.
+        Default is bands.THREADS; 1 reads them one after another.
         
     Returns      
     -------
-    resampled: dict
-        Dictionary containing the resampled images to the highest resolution available.
+    resampled: Bands
+        Dictionary-like object that reads, resamples and normalizes each image the first time it
+        is used, see bands.Bands.
 
     '''
 
     print(F"{RED}\nReading...")
-    images = dict()
-    for file in os.listdir(path):
-        if file.endswith("tif"):
-            for i in range(start, end+1):
-                file_path = f"{path}\{file}"
-                ds = rs.open(file_path)
-                images[f"B{file[-6:-4]}"] = ds.read(1)
-    print("Resampling...")
-    start = perf_counter()
-    resampled = dict()
-    # Altura de la matriz de máxima dimensión
-    height = len(images["B02"][0])
-    # Anchura de la matriz de máxima dimensión
-    width = len(images["B02"][1])
-    for file in os.listdir(path):
-        if file.endswith(".tif"):
-            with rs.open(f"{path}\{file}") as src:
-                imagen_resampled = src.read(out_shape=(height, width), # out_shape=(rows, columns)
-                                    resampling=Resampling.cubic) 
-            # Normalización de los valores de la matriz
-            imagen_resampled = imagen_resampled / np.amax(imagen_resampled)
-            # Almacenamiento en un diccionario
-            resampled[f"B{file[-6:-4]}"] = imagen_resampled
-    end = perf_counter()
-    print(f"{GREEN}Resampling time: {round(end-start, 4)} s {RESET}")
+    files = bands.find(path, start, end)
+    # Dimensiones de la matriz de máxima resolución, leídas de los metadatos
+    reference = files.get(bands.REFERENCE) or bands.find(path)[bands.REFERENCE]
+    height, width = bands.reduce(bands.shape_of(reference), preview)
+    resampling = bands.Resampling.cubic if preview is None else bands.Resampling.average
+    resampled = bands.Bands(files, (height, width), resampling, dtype=dtype, resolution=resolution,
+                            cache=cache, preview=preview, stretch=stretch, mask=masks.create(path, mask),
+                            threads=threads)
+    print(f"{GREEN}{len(resampled)} bands found, they will be read when needed {RESET}")
     return resampled
 
 def menu():
@@ -107,7 +126,8 @@ def menu():
             \n19. Normalized Differential Glacier Index (NDGI) \
             \n20. Atmospherically Resistant Vegetation Index (ARVI) \
             \n21. Structure Insensitive Pigmentation Index (SIPI) \
-            \n22. Built-up Normalized Difference Index")
+            \n22. Built-up Normalized Difference Index \
+            \n23. Several indices in one pass")
 
 def save_simple(path: str, title: str):
     '''
@@ -159,6 +179,27 @@ def save_index(path: str, title: str):
     else: 
         indices.create(comp, title) 
 
+def ask_indices():
+    '''
+    Description
+    -----------
+    Asks for the names of several indices separated by commas, and asks again while any of them
+    is not one of the available indices.
+
+    Returns
+    -------
+    names: list
+        Names of the indices as registered in indices.INDICES, e.g. ["ndvi", "ndmi"].
+    '''
+    while True:
+        names = input("Indices separated by commas (e.g. ndvi,ndmi,nbri): ")
+        names = [name.strip().lower() for name in names.split(",") if name.strip()]
+        unknown = [name for name in names if name not in indices.INDICES]
+        if names and not unknown:
+            return names
+        print(f"Wrong indices: {', '.join(unknown) or 'none given'}. "
+              f"Select among {', '.join(sorted(indices.INDICES))}.\n")
+
 def run_again():
     '''
     Description
@@ -187,7 +228,9 @@ if __name__ == "__main__":
     print(f"{BLUE}Please select the path in which your images are located\n{RESET}")
 
     path = input(f"\tFull path of the folder that contains the images: ")
-    images = read(1,12, path)
+    images = read(1,12, path, cache=cache.Cache())
+    # Las imágenes de un .zip se guardan junto al archivo
+    path = safe.folder(path)
 
     menu()
     option = int(input(f"{YELLOW}\n\nWhich composition would you like to create? Please specify the number: {RESET}"))
@@ -283,7 +326,11 @@ if __name__ == "__main__":
             comp = indices.bndi(images)
             save_index(path, "Built-up Normalized Difference Index")
             again, option = run_again()
-        if option < 1 or option >22:
+        elif option == 23:
+            for name, comp in indices.batch(images, ask_indices()).items():
+                save_index(path, name.upper())
+            again, option = run_again()
+        if option < 1 or option >23:
             print("Wrong option. Select again.\n")
             option = int(input(f"{YELLOW}\n\nWhich composition would you like to create? Please specify the number: {RESET}")) 
     
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+# Los módulos del programa se importan como en main.py, desde la carpeta Program
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import synthetic
+
+# Side in pixels of the 10 m bands of the synthetic scene: a multiple of 6, so every band has
+# a whole number of pixels, and of 32, so the windowed tests have several windows.
+SIZE = 96
+
+@pytest.fixture(scope="session")
+def scene(tmp_path_factory):
+    '''
+    Synthetic scene shared by every test, see benchmark.synthetic(). It must not be modified.
+    '''
+    return synthetic(str(tmp_path_factory.mktemp("scene")), SIZE)
@@ -0,0 +1,19 @@
+'''
+The indices computed in float32 stay within tolerance of the float64 path.
+'''
+import numpy as np
+import pytest
+from main import read
+from functions import indices
+
+# Absolute tolerance of every index. SIPI divides by B08 - B04, which can be close to zero, so
+# its float32 rounding errors are amplified.
+TOLERANCE = 1e-4
+TOLERANCES = {"sipi": 1e-3}
+
+@pytest.mark.parametrize("name", sorted(indices.INDICES))
+def test_float32_matches_float64(scene, name):
+    single = indices.compute(read(1, 12, scene, dtype="float32"), name)
+    double = indices.compute(read(1, 12, scene, dtype="float64"), name, "float64")
+    assert single.dtype == np.float32
+    assert np.allclose(single, double, atol=TOLERANCES.get(name, TOLERANCE), equal_nan=True)
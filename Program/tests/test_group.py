@@ -0,0 +1,36 @@
+'''
+The bands read together by load_group() get the same values as when read one by one by load(),
+also when their files declare a nodata value.
+'''
+import os
+import numpy as np
+import pytest
+import rasterio as rs
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from functions import bands
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("group")
+    rng = np.random.default_rng(0)
+    paths = list()
+    for number, nodata in enumerate((0, 0, None)):
+        data = rng.integers(100, 4000, (120, 120)).astype("uint16")
+        # Franja de nodata, que no debe mezclarse con sus vecinos al remuestrear
+        data[:, 40:52] = 0
+        profile = {"driver": "GTiff", "height": 120, "width": 120, "count": 1, "dtype": "uint16",
+                   "crs": "EPSG:32614", "transform": from_origin(500000, 2000000, 20, 20), "nodata": nodata}
+        path = os.path.join(folder, f"B{number}.tif")
+        with rs.open(path, "w", **profile) as dst:
+            dst.write(data, 1)
+        paths.append(path)
+    return paths
+
+@pytest.mark.parametrize("resampling", [Resampling.cubic, Resampling.bilinear, Resampling.average])
+@pytest.mark.parametrize("shape", [(240, 240), (60, 60)])
+def test_group_matches_load(files, resampling, shape):
+    group, _ = bands.load_group(files, shape, resampling)
+    for band, file_path in zip(group, files):
+        single, _ = bands.load(file_path, shape, resampling)
+        assert np.array_equal(band, single, equal_nan=True)
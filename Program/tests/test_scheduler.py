@@ -0,0 +1,57 @@
+'''
+A run started again with the same state file skips the products already written, but creates
+again those requested with other options or in another folder, and a scene path that does not
+exist is reported as failed.
+'''
+import os
+import glob
+import pytest
+import rasterio as rs
+from functions import scheduler
+import cli
+
+def written(folder, pattern):
+    return glob.glob(os.path.join(folder, "Compositions", pattern))
+
+def test_done_products_are_skipped(scene, tmp_path, capsys):
+    argv = [scene, "-i", "ndvi", "-f", "tif", "-o", str(tmp_path), "--state", str(tmp_path / "state.sqlite")]
+    assert cli.main(argv) == 0
+    file, = written(tmp_path, "*NDVI.tif")
+    modified = os.path.getmtime(file)
+    capsys.readouterr()
+    assert cli.main(argv) == 0
+    assert "already done" in capsys.readouterr().out
+    assert os.path.getmtime(file) == modified
+
+def test_other_format_or_output_is_created(scene, tmp_path):
+    state = str(tmp_path / "state.sqlite")
+    first, second = tmp_path / "first", tmp_path / "second"
+    assert cli.main([scene, "-i", "ndvi", "-o", str(first), "--state", state]) == 0
+    assert written(first, "*NDVI.png")
+    assert cli.main([scene, "-i", "ndvi", "-f", "tif", "-o", str(first), "--state", state]) == 0
+    assert written(first, "*NDVI.tif")
+    assert cli.main([scene, "-i", "ndvi", "-f", "tif", "-o", str(second), "--state", state]) == 0
+    assert written(second, "*NDVI.tif")
+
+def test_overwritten_product_is_created_again(scene, tmp_path):
+    state = str(tmp_path / "state.sqlite")
+    argv = [scene, "-i", "ndvi", "-f", "tif", "-o", str(tmp_path), "--state", state]
+    for encoding in ("int16", "float32", "int16"):
+        assert cli.main(argv + ["--encoding", encoding]) == 0
+        file, = written(tmp_path, "*NDVI.tif")
+        with rs.open(file) as src:
+            assert src.dtypes[0] == encoding
+
+def test_missing_scene_fails(scene, tmp_path):
+    missing = str(tmp_path / "typo")
+    scenes = scheduler.expand([scene, missing])
+    assert scenes == [os.path.abspath(scene), missing]
+    state = scheduler.State(str(tmp_path / "state.sqlite"))
+    failed = scheduler.run(scenes, ["index/ndvi"], lambda scene, pending: ({}, None), state)
+    assert failed == [missing]
+    assert state.pending(missing, ["index/ndvi"]) == ["index/ndvi"]
+    state.close()
+
+def test_missing_manifest_is_a_usage_error(scene, tmp_path):
+    with pytest.raises(SystemExit):
+        cli.parse([scene, "-i", "ndvi", "--manifest", str(tmp_path / "missing.txt")])
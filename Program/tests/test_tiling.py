@@ -0,0 +1,24 @@
+'''
+The windowed GeoTIFFs computed by a pool of processes are the same, bit for bit, as those
+computed in the current process.
+'''
+import os
+import numpy as np
+import rasterio as rs
+from main import read
+from functions import tiling
+
+# Índices en las rejillas de 10 m y 20 m
+NAMES = ("ndvi", "ndmi", "evi")
+
+def test_pool_matches_serial(scene, tmp_path):
+    images = read(1, 12, scene)
+    arrays = dict()
+    for workers in (1, 2):
+        outputs = {name: os.path.join(tmp_path, f"{name}-{workers}.tif") for name in NAMES}
+        tiling.stream_many(images, outputs, size=32, workers=workers)
+        for name, path in outputs.items():
+            with rs.open(path) as src:
+                arrays[name, workers] = src.read()
+    for name in NAMES:
+        assert np.array_equal(arrays[name, 1], arrays[name, 2], equal_nan=True)
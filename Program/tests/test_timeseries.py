@@ -0,0 +1,25 @@
+'''
+Updating a time series appends each date once: scenes of a date already stored, or several
+scenes of the same date, add nothing.
+'''
+import shutil
+import pytest
+from functions import timeseries
+
+pytest.importorskip("zarr")
+
+NAMES = ["ndvi", "ndmi"]
+
+def test_dates_are_appended_once(scene, tmp_path):
+    directory = tmp_path / "T00XXX"
+    # Carpetas con la fecha sola, como las del programa; la copia repite una fecha
+    for folder in ("T00XXX_20200101", "T00XXX_20200101_copy", "T00XXX_20200106"):
+        shutil.copytree(scene, directory / folder)
+    store_path = str(tmp_path / "T00XXX.zarr")
+    added = timeseries.update(str(directory), store_path, NAMES, verbose=False)
+    assert added == {"20200101": NAMES, "20200106": NAMES}
+    assert timeseries.update(str(directory), store_path, NAMES, verbose=False) == {}
+    store = timeseries.Store(store_path)
+    for name in NAMES:
+        assert store.dates(name) == ["20200101", "20200106"]
+        assert store.array(name).shape[0] == 2